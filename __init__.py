@@ -3,7 +3,11 @@
 
 from trytond.pool import Pool
 from . import plan
+from . import bom
 from . import configuration
+from . import ir
+from . import product
+from . import uom
 
 
 def register():
@@ -13,10 +17,23 @@ def register():
         plan.PlanProductLine,
         plan.PlanCostType,
         plan.PlanCost,
+        plan.PlanSnapshot,
+        plan.PlanBOMDigest,
+        plan.PlanWhereUsed,
         configuration.Configuration,
         configuration.ConfigurationProductcostPlan,
         plan.CreateBomStart,
+        plan.ExportBreakdownStart,
+        plan.ExportBreakdownResult,
+        ir.Cron,
+        product.ProductCostPrice,
+        uom.Uom,
+        bom.BOM,
+        bom.BOMInput,
+        bom.BOMOutput,
+        bom.ProductBOM,
         module='product_cost_plan', type_='model')
     Pool.register(
         plan.CreateBom,
+        plan.ExportBreakdown,
         module='product_cost_plan', type_='wizard')
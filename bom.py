@@ -0,0 +1,122 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import hashlib
+
+from trytond import backend
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction, without_check_access
+
+__all__ = ['BOM', 'BOMInput', 'BOMOutput', 'ProductBOM']
+
+
+class FindBOMsCacheMixin(object):
+    __slots__ = ()
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        super().on_modification(mode, records, field_names=field_names)
+        Plan._find_boms_cache.clear()
+        Plan._sub_assembly_cost_cache.clear()
+
+
+class CostPlanDigestMixin(object):
+    "Updates the cost plan digest of the BOMs of the inputs or outputs"
+    __slots__ = ()
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        super().on_modification(mode, records, field_names=field_names)
+        if mode != 'delete':
+            BOM.update_cost_plan_digest(list({r.bom for r in records}))
+
+    @classmethod
+    def on_write(cls, records, values):
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        callback = super().on_write(records, values)
+        if 'bom' in values:
+            bom_ids = list({r.bom.id for r in records})
+            callback.append(
+                lambda: BOM.update_cost_plan_digest(BOM.browse(bom_ids)))
+        return callback
+
+    @classmethod
+    def on_delete(cls, records):
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        callback = super().on_delete(records)
+        bom_ids = list({r.bom.id for r in records})
+        # The BOMs may be deleted with their inputs and outputs
+        callback.append(lambda: BOM.update_cost_plan_digest(BOM.search([
+                        ('id', 'in', bom_ids),
+                        ])))
+        return callback
+
+
+class BOM(FindBOMsCacheMixin, metaclass=PoolMeta):
+    __name__ = 'production.bom'
+    cost_plan_digest = fields.Char('Cost Plan Digest', readonly=True,
+        help='The digest of the inputs and outputs used by the cost plans.')
+
+    @classmethod
+    def on_modification(cls, mode, boms, field_names=None):
+        super().on_modification(mode, boms, field_names=field_names)
+        if mode == 'create':
+            cls.update_cost_plan_digest(boms)
+
+    @classmethod
+    def copy(cls, boms, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('cost_plan_digest', None)
+        return super().copy(boms, default=default)
+
+    @classmethod
+    @without_check_access
+    def update_cost_plan_digest(cls, boms):
+        "Stores the digests of the BOMs and returns them by id"
+        pool = Pool()
+        Input = pool.get('production.bom.input')
+        Output = pool.get('production.bom.output')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        values = {b.id: ([], []) for b in boms}
+        for sub_ids in grouped_slice(list(values), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            for input_ in Input.search([('bom', 'in', sub_ids)]):
+                values[input_.bom.id][0].append((
+                        input_.product.id, input_.quantity, input_.unit.id,
+                        getattr(input_, 'party_stock', False)))
+            for output in Output.search([('bom', 'in', sub_ids)]):
+                values[output.bom.id][1].append((
+                        output.product.id, output.quantity, output.unit.id))
+
+        digests = {}
+        for bom_id, (inputs, outputs) in values.items():
+            digests[bom_id] = digest = hashlib.sha256(
+                repr((sorted(inputs), sorted(outputs))).encode()).hexdigest()
+            cursor.execute(*table.update(
+                    [table.cost_plan_digest], [digest],
+                    where=table.id == bom_id))
+        return digests
+
+
+class BOMInput(FindBOMsCacheMixin, CostPlanDigestMixin, metaclass=PoolMeta):
+    __name__ = 'production.bom.input'
+
+
+class BOMOutput(FindBOMsCacheMixin, CostPlanDigestMixin, metaclass=PoolMeta):
+    __name__ = 'production.bom.output'
+
+
+class ProductBOM(FindBOMsCacheMixin, metaclass=PoolMeta):
+    __name__ = 'product.product-production.bom'
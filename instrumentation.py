@@ -0,0 +1,160 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import time
+from contextlib import contextmanager
+from functools import wraps
+from weakref import WeakKeyDictionary
+
+import trytond.config as config
+from trytond.transaction import Transaction
+
+__all__ = ['enabled', 'measure', 'instrumented', 'get_statistics',
+    'diff_statistics', 'format_statistics']
+
+INSTRUMENTATION = config.getboolean(
+    'product_cost_plan', 'instrumentation', default=False)
+
+_states = WeakKeyDictionary()
+
+
+def enabled():
+    "Returns if the operations must be instrumented"
+    transaction = Transaction()
+    if transaction.context is None:
+        return False
+    return transaction.context.get(
+        'cost_plan_instrumentation', INSTRUMENTATION)
+
+
+class _State(object):
+    "Statistics and query counter of a transaction"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statistics = {}
+        self.running = set()
+        self.depth = 0
+        self.queries = 0
+        self._cursor_factory = None
+
+    def _count(self, query=None):
+        if isinstance(query, str) and query.startswith(
+                ('SAVEPOINT', 'RELEASE', 'PRAGMA')):
+            return
+        self.queries += 1
+
+    def start_counting(self):
+        if self.depth == 0:
+            if hasattr(self.connection, 'set_trace_callback'):
+                # SQLite
+                self.connection.set_trace_callback(self._count)
+            elif hasattr(self.connection, 'cursor_factory'):
+                # PostgreSQL
+                self._cursor_factory = factory = self.connection.cursor_factory
+                state = self
+
+                class CountingCursor(factory):
+                    def execute(self, query, *args, **kwargs):
+                        state._count(query)
+                        return super().execute(query, *args, **kwargs)
+
+                self.connection.cursor_factory = CountingCursor
+        self.depth += 1
+
+    def stop_counting(self):
+        self.depth -= 1
+        if self.depth == 0:
+            if hasattr(self.connection, 'set_trace_callback'):
+                self.connection.set_trace_callback(None)
+            elif self._cursor_factory is not None:
+                self.connection.cursor_factory = self._cursor_factory
+                self._cursor_factory = None
+
+
+def _get_state():
+    transaction = Transaction()
+    state = _states.get(transaction)
+    if state is None:
+        state = _states[transaction] = _State(transaction.connection)
+    return state
+
+
+@contextmanager
+def measure(name, records=0):
+    "Measures the block under name in the transaction"
+    values = {'records': records}
+    if not enabled():
+        yield values
+        return
+    state = _get_state()
+    if name in state.running:
+        yield values
+        return
+    state.running.add(name)
+    state.start_counting()
+    queries = state.queries
+    start = time.perf_counter()
+    try:
+        yield values
+    finally:
+        duration = time.perf_counter() - start
+        state.stop_counting()
+        state.running.discard(name)
+        statistics = state.statistics.setdefault(name, {
+                'calls': 0,
+                'seconds': 0.0,
+                'queries': 0,
+                'records': 0,
+                })
+        statistics['calls'] += 1
+        statistics['seconds'] += duration
+        statistics['queries'] += state.queries - queries
+        statistics['records'] += values['records']
+
+
+def instrumented(name):
+    "Decorates a method to measure its calls under name"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self_or_cls, *args, **kwargs):
+            if not enabled():
+                return func(self_or_cls, *args, **kwargs)
+            with measure(name) as values:
+                result = func(self_or_cls, *args, **kwargs)
+                if args and isinstance(args[0], (list, tuple)):
+                    values['records'] = len(args[0])
+                elif isinstance(result, list):
+                    values['records'] = len(result)
+                else:
+                    values['records'] = 1
+            return result
+        return wrapper
+    return decorator
+
+
+def get_statistics():
+    "Returns a copy of the statistics of the transaction"
+    state = _states.get(Transaction())
+    if state is None:
+        return {}
+    return {k: dict(v) for k, v in state.statistics.items()}
+
+
+def diff_statistics(after, before):
+    "Returns the statistics of after not already in before"
+    result = {}
+    for name, values in after.items():
+        previous = before.get(name, {})
+        values = {k: v - previous.get(k, 0) for k, v in values.items()}
+        if values['calls']:
+            result[name] = values
+    return result
+
+
+def format_statistics(statistics):
+    "Returns a human readable text of the statistics"
+    return '\n'.join(
+        '%s: %d calls, %.3fs, %d queries, %d records' % (
+            name, values['calls'], values['seconds'], values['queries'],
+            values['records'])
+        for name, values in sorted(statistics.items()))
@@ -0,0 +1,19 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('product.cost.plan|compute_all', "Compute Cost Plans"),
+                ('product.cost.plan|compute_stale',
+                    "Compute Stale Cost Plans"),
+                ('product.cost.plan|check_costs', "Check Cost Plans Costs"),
+                ])
@@ -1,19 +1,85 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import hashlib
+import io
+import json
+import logging
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from decimal import Decimal
-# from sql import Null
-from trytond.model import ModelSQL, ModelView, DeactivableMixin, fields, tree
+from functools import partial
+from sql import Column, Literal, Null, Select, Window
+from sql.aggregate import Count, Max, Min
+from sql.functions import CurrentTimestamp, RowNumber
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import (ModelSQL, ModelView, DeactivableMixin, Index,
+    fields, tree)
 from trytond.pool import Pool
-from trytond.pyson import Eval, Bool, If
-from trytond.transaction import Transaction
+from trytond.pyson import Eval, Bool, If, PYSONEncoder
+from trytond.rpc import RPC
+from trytond.transaction import Transaction, without_check_access
 from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.i18n import gettext
-from trytond.exceptions import UserWarning
+from trytond.exceptions import UserError, UserWarning
 from trytond.modules.product import price_digits, round_price
-from trytond.model.exceptions import ValidationError
+from .uom import compute_factor, compute_qty, compute_price
+from .instrumentation import (instrumented, measure, get_statistics,
+    diff_statistics, format_statistics, enabled as instrumentation_enabled)
+from trytond.model.exceptions import AccessError, ValidationError
+from trytond.tools import grouped_slice
+import trytond.config as config
 
 __all__ = ['PlanCostType', 'Plan', 'PlanBOM', 'PlanProductLine', 'PlanCost',
-    'CreateBomStart', 'CreateBom']
+    'PlanSnapshot', 'PlanBOMDigest', 'PlanWhereUsed', 'CreateBomStart',
+    'ExportBreakdownStart', 'ExportBreakdownResult', 'ExportBreakdown',
+    'CreateBom']
+
+logger = logging.getLogger(__name__)
+
+COMPUTE_CHUNK_SIZE = config.getint(
+    'product_cost_plan', 'compute_chunk_size', default=100)
+COMPUTE_WORKERS = config.getint(
+    'product_cost_plan', 'compute_workers', default=1)
+BULK_INSERT_THRESHOLD = config.getint(
+    'product_cost_plan', 'bulk_insert_threshold', default=1000)
+EXPORT_BATCH_SIZE = config.getint(
+    'product_cost_plan', 'export_batch_size', default=1000)
+QUEUE_COMPUTE = config.getboolean(
+    'product_cost_plan', 'queue_compute', default=False)
+# Seconds after which a queued or running compute is considered lost
+COMPUTE_TIMEOUT = config.getint(
+    'product_cost_plan', 'compute_timeout', default=60 * 60)
+SNAPSHOT_ON_COMPUTE = config.getboolean(
+    'product_cost_plan', 'snapshot_on_compute', default=False)
+# Number of snapshots kept for each plan, all are kept when it is 0
+SNAPSHOT_RETENTION = config.getint(
+    'product_cost_plan', 'snapshot_retention', default=10)
+BREAKDOWN_COLUMNS = ['plan', 'line', 'level', 'name', 'product', 'quantity',
+    'uom', 'product_cost_price', 'cost_price', 'unit_cost', 'total_cost']
+# The line ids are not kept as the lines are deleted on the next compute
+SNAPSHOT_COLUMNS = BREAKDOWN_COLUMNS[2:]
+SNAPSHOT_DECIMAL_COLUMNS = {'product_cost_price', 'cost_price', 'unit_cost',
+    'total_cost'}
+
+
+def _searched_booleans(clause):
+    "Returns the boolean values matched by the clause of a boolean searcher"
+    _, operator, value = clause[:3]
+    if operator in {'=', '!='}:
+        values = {bool(value)}
+    elif operator in {'in', 'not in'}:
+        values = {bool(v) for v in value or []}
+    else:
+        return set()
+    if operator in {'!=', 'not in'}:
+        values = {True, False} - values
+    return values
 
 
 class PlanCostType(ModelSQL, ModelView):
@@ -22,6 +88,24 @@ class PlanCostType(ModelSQL, ModelView):
     name = fields.Char('Name', required=True, translate=True)
     system = fields.Boolean('System Managed', readonly=True)
     plan_field_name = fields.Char('Plan Field Name', readonly=True)
+    _system_types_cache = Cache('product.cost.plan.cost.type.system',
+        context=False)
+
+    @classmethod
+    def on_modification(cls, mode, types, field_names=None):
+        super().on_modification(mode, types, field_names=field_names)
+        cls._system_types_cache.clear()
+
+    @classmethod
+    def get_system_types(cls):
+        "Returns the plan field name of the system cost types by id"
+        types = cls._system_types_cache.get(None)
+        if types is None:
+            types = [(t.id, t.plan_field_name) for t in cls.search([
+                        ('system', '=', True),
+                        ])]
+            cls._system_types_cache.set(None, types)
+        return dict(types)
 
 
 class Plan(DeactivableMixin, ModelSQL, ModelView):
@@ -55,17 +139,46 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
     all_products = fields.Function(fields.Many2Many(
             'product.cost.plan.product_line', None, None, 'All Products'),
         'get_all_products')
-    products_cost = fields.Function(fields.Numeric('Products Cost',
-            digits=price_digits),
-        'get_products_cost')
+    products_cost = fields.Numeric('Products Cost', digits=price_digits,
+        readonly=True)
     costs = fields.One2Many('product.cost.plan.cost', 'plan', 'Costs')
     product_cost_price = fields.Function(fields.Numeric('Product Cost Price',
             digits=price_digits),
         'on_change_with_product_cost_price')
-    cost_price = fields.Function(fields.Numeric('Unit Cost Price',
-            digits=price_digits),
-        'get_cost_price')
+    cost_price = fields.Numeric('Unit Cost Price', digits=price_digits,
+        readonly=True)
     notes = fields.Text('Notes')
+    compute_statistics = fields.Text('Last Compute Statistics',
+        readonly=True)
+    rolled_up = fields.Boolean('Rolled-up Sub-assemblies',
+        help='Compute a single line with the unit cost of each sub-assembly '
+        'instead of a line for each of its components.')
+    compute_state = fields.Selection([
+            (None, ''),
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'Compute State', readonly=True)
+    compute_pending = fields.Function(fields.Boolean('Compute Pending',
+            help='The compute is queued or running and was updated less '
+            'than the compute timeout ago.'),
+        'get_compute_pending', searcher='search_compute_pending')
+    compute_progress = fields.Float('Compute Progress', digits=(16, 2),
+        readonly=True, help='Percentage of the plans of the queued compute '
+        'already computed.')
+    compute_duration = fields.TimeDelta('Compute Duration', readonly=True)
+    snapshots = fields.One2Many('product.cost.plan.snapshot', 'plan',
+        'Snapshots', readonly=True)
+    bom_digests = fields.One2Many('product.cost.plan.bom_digest', 'plan',
+        'BOM Digests', readonly=True,
+        help='The digests of the BOMs when the plan was computed.')
+    stale = fields.Function(fields.Boolean('Stale',
+            help='The BOMs changed since the plan was computed.'),
+        'get_stale', searcher='search_stale')
+    _find_boms_cache = Cache('product.cost.plan.find_boms', context=False)
+    _sub_assembly_cost_cache = Cache('product.cost.plan.sub_assembly_cost',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -73,12 +186,104 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
         cls._buttons.update({
                 'compute': {
                     'icon': 'tryton-spreadsheet',
+                    'readonly': Eval('compute_pending', False),
+                    'depends': ['compute_pending'],
                     },
                 'update_product_cost_price': {
                     'icon': 'tryton-refresh',
                     },
+                'update_costs': {
+                    'icon': 'tryton-refresh',
+                    },
+                })
+        cls.__rpc__.update({
+                'simulate': RPC(),
+                'price_curve': RPC(instantiate=0),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        fill_costs = (backend.TableHandler.table_exist(cls._table)
+            and not cls.__table_handler__(module_name).column_exist(
+                'products_cost'))
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: store the products cost and the cost price
+        if fill_costs:
+            cls._fill_stored_costs()
+
+    @classmethod
+    def _fill_stored_costs(cls):
+        "Fills the products cost and the cost price of all the plans"
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
+        Cost = pool.get('product.cost.plan.cost')
+        CostType = pool.get('product.cost.plan.cost.type')
+        table = cls.__table__()
+        line = ProductLine.__table__()
+        cost = Cost.__table__()
+        cost_type = CostType.__table__()
+        cursor = Transaction().connection.cursor()
+
+        tree_values = {}
+        cursor.execute(*line.select(line.id, line.parent, line.plan,
+                line.quantity, line.cost_price))
+        for id_, parent, plan, quantity, cost_price in cursor:
+            tree_values[id_] = {
+                'id': id_,
+                'parent': parent,
+                'plan': plan,
+                'quantity': quantity,
+                'cost_price': cost_price,
+                }
+        plan_lines = defaultdict(list)
+        for id_, values in tree_values.items():
+            while values['parent'] is not None:
+                values = tree_values[values['parent']]
+            if values['plan'] is not None:
+                plan_lines[values['plan']].append(ProductLine(id_))
+
+        products_costs = {}
+        cursor.execute(*table.select(table.id, table.quantity))
+        for id_, quantity in cursor:
+            if not quantity:
+                products_costs[id_] = Decimal(0)
+                continue
+            products_cost = ProductLine.sum_total_costs(
+                plan_lines[id_], tree_values=tree_values)
+            products_costs[id_] = round_price(
+                products_cost / Decimal(str(quantity)))
+
+        cost_prices = defaultdict(Decimal)
+        cursor.execute(*cost.join(cost_type,
+                condition=cost.type == cost_type.id
+                ).select(cost.plan, cost.system, cost_type.plan_field_name,
+                cost.internal_cost))
+        for plan, system, field_name, internal_cost in cursor:
+            if system:
+                value = {
+                    'products_cost': products_costs.get(plan),
+                    }.get(field_name)
+            else:
+                value = internal_cost
+            if value:
+                cost_prices[plan] += round_price(value)
+
+        for id_, products_cost in products_costs.items():
+            cursor.execute(*table.update(
+                    [table.products_cost, table.cost_price],
+                    [products_cost, cost_prices.get(id_, Decimal(0))],
+                    where=table.id == id_))
+
+    @staticmethod
+    def default_products_cost():
+        return Decimal(0)
+
+    @staticmethod
+    def default_cost_price():
+        return Decimal(0)
+
     def get_rec_name(self, name):
         res = '[%s]' % self.number
         if self.name:
@@ -129,17 +334,49 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
 
     @fields.depends('bom')
     def find_boms(self, inputs=None):
-        res = []
+        "Returns the product and BOM ids of the sub-assemblies of the BOM"
         if not self.bom:
-            return res
-        if not inputs:
-            inputs = self.bom.inputs
-        for input_ in inputs:
-            if input_.product.boms:
-                product_bom = input_.product.boms[0].bom
-                res.append((input_.product.id, product_bom.id))
-                if product_bom.id not in (x[1] for x in res):
-                    res += self.find_boms(product_bom.inputs)
+            return []
+        if inputs:
+            return self._resolve_boms(inputs)
+        res = self._find_boms_cache.get(self.bom.id)
+        if res is None:
+            res = self._resolve_boms(self.bom.inputs)
+            self._find_boms_cache.set(self.bom.id, res)
+        return [tuple(x) for x in res]
+
+    @classmethod
+    def _resolve_boms(cls, inputs):
+        "Returns the product and BOM ids of the sub-assemblies of the inputs"
+        pool = Pool()
+        Input = pool.get('production.bom.input')
+        ProductBOM = pool.get('product.product-production.bom')
+
+        res = []
+        products = set()
+        boms = {i.bom.id for i in inputs if i.bom}
+        while inputs:
+            product_ids = []
+            for input_ in inputs:
+                if input_.product and input_.product.id not in products:
+                    products.add(input_.product.id)
+                    product_ids.append(input_.product.id)
+            product2bom = {}
+            for product_bom in ProductBOM.search([
+                        ('product', 'in', product_ids),
+                        ]):
+                product2bom.setdefault(
+                    product_bom.product.id, product_bom.bom.id)
+            to_walk = []
+            for product_id in product_ids:
+                bom_id = product2bom.get(product_id)
+                if bom_id is None:
+                    continue
+                res.append((product_id, bom_id))
+                if bom_id not in boms:
+                    boms.add(bom_id)
+                    to_walk.append(bom_id)
+            inputs = Input.search([('bom', 'in', to_walk)]) if to_walk else []
         return res
 
     @fields.depends('bom', 'boms', 'product')
@@ -158,25 +395,35 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
                     ))
         return res
 
+    @instrumented('Plan.get_all_products')
     def get_all_products(self, name):
-        # return all lines in product cost plan (parent and children)
-        product_lines = []
-
-        def _get_children(line):
-            product_lines.append(line)
-            for child in line.children:
-                _get_children(child)
-
-        for line in self.products:
-            _get_children(line)
-
-        return [x.id for x in product_lines]
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
 
+        # return all lines in product cost plan (parent and children) in
+        # depth first order
+        children = defaultdict(list)
+        for line in ProductLine.search_read([
+                    ('parent', 'child_of', [l.id for l in self.products]),
+                    ], fields_names=['parent']):
+            children[line['parent']].append(line['id'])
+        product_lines = []
+        stack = [l.id for l in reversed(self.products)]
+        while stack:
+            line_id = stack.pop()
+            product_lines.append(line_id)
+            stack.extend(reversed(children.pop(line_id, [])))
+        return product_lines
+
+    @instrumented('Plan.get_products_cost')
     def get_products_cost(self, name):
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
+
         if not self.quantity:
             return Decimal(0)
         lines = Plan.get_all_inputs(self.products)
-        cost = sum(p.get_total_cost(None, round=False) for p in lines)
+        cost = ProductLine.sum_total_costs(lines)
         cost /= Decimal(str(self.quantity))
         return round_price(cost)
 
@@ -184,74 +431,591 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
     def on_change_with_product_cost_price(self, name=None):
         return self.product.cost_price if self.product else None
 
+    @instrumented('Plan.get_cost_price')
     def get_cost_price(self, name):
         return Decimal(sum(c.cost for c in self.costs if c.cost))
 
+    @classmethod
+    @ModelView.button
+    def update_costs(cls, plans):
+        cls.store_costs(plans)
+
+    @classmethod
+    @without_check_access
+    def store_costs(cls, plans):
+        "Stores the costs of the plans and returns the updated ones"
+        updated = set()
+        # The system costs use the products cost so it must be stored before
+        # the cost price is computed
+        for name in ['products_cost', 'cost_price']:
+            to_write = []
+            for plan in cls.browse(plans):
+                value = getattr(plan, 'get_%s' % name)(name)
+                if getattr(plan, name) != value:
+                    to_write.extend(([plan], {name: value}))
+                    updated.add(plan)
+            if to_write:
+                cls.write(*to_write)
+        return list(updated)
+
+    @classmethod
+    def check_costs(cls, plans=None):
+        "Rebuilds the stored costs of the plans that are not up to date"
+        if plans is None:
+            with Transaction().set_context(active_test=False):
+                plans = cls.search([])
+        updated = cls.store_costs(plans)
+        if updated:
+            logger.warning('Rebuilt stored costs of cost plans %s',
+                [p.id for p in updated])
+        return updated
+
+    @classmethod
+    def on_modification(cls, mode, plans, field_names=None):
+        pool = Pool()
+        BOMDigest = pool.get('product.cost.plan.bom_digest')
+        super().on_modification(mode, plans, field_names=field_names)
+        if mode == 'write' and field_names & {'product', 'bom', 'boms'}:
+            # The plans must be computed again with the new BOMs
+            BOMDigest.clear(plans)
+        if (mode == 'write' and field_names and 'quantity' in field_names
+                and not Transaction().context.get('skip_update_costs')):
+            cls.store_costs(plans)
+
     @classmethod
     def clean(cls, plans):
+        if cls.check_product_lines_removal(plans):
+            cls._delete_product_lines(plans)
+
+        with Transaction().set_context(reset_costs=True):
+            cls._delete_costs(plans, system=True)
+
+    @classmethod
+    def check_product_lines_removal(cls, plans):
+        "Warns if the plans have product lines and returns if they have"
         pool = Pool()
         ProductLine = pool.get('product.cost.plan.product_line')
-        CostLine = pool.get('product.cost.plan.cost')
-        Warning = Pool().get('res.user.warning')
+        Warning = pool.get('res.user.warning')
 
         product_lines = ProductLine.search([
                 ('plan', 'in', [p.id for p in plans]),
-                ])
+                ], limit=1)
         if product_lines:
             key = 'task_product_lines_will_be_removed.%d' % product_lines[0].id
             if Warning.check(key):
                 raise UserWarning(key,
                     gettext('product_cost_plan.product_lines_will_be_removed'))
-            ProductLine.delete(product_lines)
+        return bool(product_lines)
 
-        with Transaction().set_context(reset_costs=True):
-            CostLine.delete(CostLine.search([
-                        ('plan', 'in', [p.id for p in plans]),
-                        ('system', '=', True),
-                        ]))
+    @classmethod
+    def _delete_product_lines(cls, plans):
+        "Deletes the product lines of the plans"
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        ProductLine = pool.get('product.cost.plan.product_line')
+        line = ProductLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ModelAccess.check(ProductLine.__name__, 'delete')
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            where = fields.SQL_OPERATORS['in'](
+                line.root_plan, [p.id for p in sub_plans])
+            cursor.execute(*line.select(line.id, where=where))
+            ids = [i for i, in cursor]
+            cls._delete_resources(ProductLine, ids)
+            cursor.execute(*line.delete(where=where))
+            cls._clear_deleted(ProductLine, ids)
+
+    @classmethod
+    def _delete_costs(cls, plans, system=None):
+        "Deletes the system or non system cost lines of the plans"
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        CostLine = pool.get('product.cost.plan.cost')
+        cost = CostLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        assert Transaction().context.get('reset_costs', False)
+        ModelAccess.check(CostLine.__name__, 'delete')
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            where = fields.SQL_OPERATORS['in'](
+                cost.plan, [p.id for p in sub_plans])
+            if system is not None:
+                where &= cost.system == system
+            cursor.execute(*cost.select(cost.id, where=where))
+            ids = [i for i, in cursor]
+            cls._delete_resources(CostLine, ids)
+            cursor.execute(*cost.delete(where=where))
+            cls._clear_deleted(CostLine, ids)
+
+    @classmethod
+    def _delete_resources(cls, Model, ids):
+        "Deletes the attachments and notes of the records like delete"
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Note = pool.get('ir.note')
+
+        for Resource in [Attachment, Note]:
+            for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+                resources = Resource.search([
+                        ('resource', 'in', [
+                                '%s,%s' % (Model.__name__, i)
+                                for i in sub_ids]),
+                        ])
+                if resources:
+                    Resource.delete(resources)
+
+    @classmethod
+    def _clear_deleted(cls, Model, ids):
+        "Clears the cache of the records deleted from the table like delete"
+        transaction = Transaction()
+        if not ids:
+            return
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if Model.__name__ in cache:
+                cache_model = cache[Model.__name__]
+                for id_ in ids:
+                    cache_model.pop(id_, None)
 
     @classmethod
     @ModelView.button
     def compute(cls, plans):
+        "Computes the plans or enqueues their compute"
+        cls.check_compute_state(plans)
+        if Transaction().context.get('queue_cost_plan_compute', QUEUE_COMPUTE):
+            cls.enqueue_compute(plans)
+        else:
+            cls._compute(plans)
+
+    @classmethod
+    def _compute_timeout_date(cls):
+        return (datetime.datetime.now()
+            - datetime.timedelta(seconds=COMPUTE_TIMEOUT))
+
+    def get_compute_pending(self, name):
+        # A compute that was not updated for too long is lost, its worker
+        # died or its task was dropped, so the plan can be computed again
+        return bool(self.compute_state in {'queued', 'running'}
+            and self.write_date
+            and self.write_date >= self._compute_timeout_date())
+
+    @classmethod
+    def search_compute_pending(cls, name, clause):
+        values = _searched_booleans(clause)
+        if values == {True, False}:
+            return []
+        elif values == {True}:
+            return [
+                ('compute_state', 'in', ['queued', 'running']),
+                ('write_date', '>=', cls._compute_timeout_date()),
+                ]
+        elif values == {False}:
+            return ['OR',
+                ('compute_state', '=', None),
+                ('compute_state', 'not in', ['queued', 'running']),
+                ('write_date', '=', None),
+                ('write_date', '<', cls._compute_timeout_date()),
+                ]
+        return [('id', '=', None)]
+
+    @classmethod
+    def check_compute_state(cls, plans):
+        "Raises if the compute of one of the plans is pending"
+        for plan in plans:
+            if plan.compute_pending:
+                raise UserError(gettext(
+                        'product_cost_plan.msg_plan_compute_pending',
+                        cost_plan=plan.rec_name))
+
+    @classmethod
+    def enqueue_compute(cls, plans):
+        "Enqueues the compute of the plans and returns them"
+        cls.lock(plans)
+        plans = [p for p in cls.browse(plans) if not p.compute_pending]
+        if not plans:
+            return []
+        # The compute runs without warnings so they are checked here
+        cls.check_product_lines_removal(plans)
+        with without_check_access():
+            cls.write(plans, {
+                    'compute_state': 'queued',
+                    'compute_progress': 0,
+                    'compute_duration': None,
+                    })
+        cls.__queue__.compute_queued(plans)
+        return plans
+
+    @classmethod
+    def compute_queued(cls, plans):
+        "Computes the queued plans and stores their progress"
+        plans = [p for p in plans if p.compute_state == 'queued']
+        if not plans:
+            return
+        cls._write_compute_state(plans, {
+                'compute_state': 'running',
+                'compute_progress': 0,
+                })
+        computed = 0
+
+        def progress(result, pending):
+            nonlocal computed
+            computed += len(result['plans'])
+            # The plans of the running chunks are locked by their transactions
+            cls._write_compute_state(cls.browse(pending), {
+                    'compute_progress': round(
+                        computed * 100 / len(plans), 2),
+                    })
+
+        try:
+            cls.compute_batch(plans, callback=progress)
+        except Exception:
+            cls._write_compute_state(plans, {'compute_state': 'failed'},
+                only_running=True)
+            raise
+
+    @classmethod
+    def _write_compute_state(cls, plans, values, only_running=False):
+        "Writes the compute values of the plans in a new transaction"
+        ids = [p.id for p in plans]
+        with Transaction().new_transaction():
+            with without_check_access():
+                plans = cls.browse(ids)
+                if only_running:
+                    plans = [p for p in plans if p.compute_state == 'running']
+                if plans:
+                    cls.write(plans, values)
+
+    @classmethod
+    def _compute(cls, plans):
         pool = Pool()
         ProductLine = pool.get('product.cost.plan.product_line')
         CostLine = pool.get('product.cost.plan.cost')
+        Snapshot = pool.get('product.cost.plan.snapshot')
+        BOMDigest = pool.get('product.cost.plan.bom_digest')
 
-        cls.clean(plans)
+        start = time.perf_counter()
+        before = get_statistics()
+        plans = cls._lock_compute(plans)
+        if not plans:
+            return
+        with measure('Plan.compute', len(plans)):
+            with Transaction().set_context(skip_update_costs=True):
+                cls.clean(plans)
+
+                to_create = cls.explode_boms(plans)
+                if len(to_create) >= BULK_INSERT_THRESHOLD:
+                    ProductLine.bulk_create(to_create)
+                elif to_create:
+                    ProductLine.create(to_create)
+
+                to_create = []
+                for plan in plans:
+                    to_create.extend(plan.get_costs())
+                if to_create:
+                    CostLine.create(to_create)
+            cls.store_costs(plans)
+            if Transaction().context.get(
+                    'cost_plan_snapshot', SNAPSHOT_ON_COMPUTE):
+                Snapshot.take(plans)
+        duration = datetime.timedelta(seconds=time.perf_counter() - start)
+        with without_check_access():
+            cls.write(plans, {
+                    'compute_state': 'done',
+                    'compute_progress': 100,
+                    'compute_duration': duration,
+                    })
+            BOMDigest.record(plans)
+        if instrumentation_enabled():
+            cls._store_compute_statistics(plans,
+                diff_statistics(get_statistics(), before))
 
-        to_create = []
+    @classmethod
+    def _lock_compute(cls, plans):
+        "Locks the plans and returns the ones to compute"
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+
+        plans = sorted(plans, key=lambda p: p.id)
+        waited = []
         for plan in plans:
-            if plan.product and plan.bom:
-                to_create.extend(plan.explode_bom(plan.product, plan.bom,
-                        plan.quantity, plan.uom))
-        if to_create:
-            ProductLine.create(to_create)
+            key = '%s,compute,%s' % (cls.__name__, plan.id)
+            lock_id = int(hashlib.sha256(key.encode()).hexdigest(), 16) % 2**63
+            cursor.execute(*Select([database.lock_id(lock_id)]))
+            if cursor.fetchone()[0]:
+                continue
+            # Read the plan before the other transaction commits
+            waited.append((plan, plan.compute_state, plan.write_date))
+            with measure('Plan.compute.lock_wait', 1):
+                cursor.execute(*Select([database.lock_id(lock_id, True)]))
+        if not waited:
+            return plans
+
+        reused = set()
+        with transaction.new_transaction(readonly=True):
+            current = {p.id: (p.compute_state, p.write_date)
+                for p in cls.browse([p.id for p, _, _ in waited])}
+        for plan, state, write_date in waited:
+            if (current[plan.id][0] == 'done'
+                    and current[plan.id] != (state, write_date)):
+                reused.add(plan)
+        if reused:
+            logger.info('Reused the concurrent compute of cost plans %s',
+                [p.id for p in reused])
+        return [p for p in plans if p not in reused]
+
+    @classmethod
+    def _store_compute_statistics(cls, plans, statistics):
+        "Logs the statistics of a compute and stores them on the plans"
+        logger.info('compute statistics %s', json.dumps({
+                    'plans': [p.id for p in plans],
+                    'statistics': statistics,
+                    }, sort_keys=True))
+        with without_check_access():
+            cls.write(list(plans), {
+                    'compute_statistics': format_statistics(statistics),
+                    })
+
+    @classmethod
+    def compute_all(cls):
+        "Computes all the plans with a product and a BOM"
+        plans = cls.search([
+                ('product', '!=', None),
+                ('bom', '!=', None),
+                ('compute_pending', '=', False),
+                ])
+        return cls._compute_scheduled(plans)
+
+    @classmethod
+    def compute_stale(cls):
+        "Computes the plans which BOMs changed since they were computed"
+        plans = cls.search([
+                ('stale', '=', True),
+                ('compute_pending', '=', False),
+                ])
+        return cls._compute_scheduled(plans)
+
+    @classmethod
+    def _compute_scheduled(cls, plans):
+        if Transaction().context.get('queue_cost_plan_compute', QUEUE_COMPUTE):
+            cls.enqueue_compute(plans)
+            return []
+        return cls.compute_batch(plans)
+
+    @classmethod
+    def get_exploded_boms(cls, plans):
+        "Returns the ids of the BOMs exploded by each plan id"
+        graph = cls.get_bom_graph(plans)
+        result = {}
+        for plan in plans:
+            result[plan.id] = boms = set()
+            if not plan.product or not plan.bom:
+                continue
+            plan_boms = plan.get_plan_boms()
+            to_walk = [plan.bom.id]
+            while to_walk:
+                bom_id = to_walk.pop()
+                if bom_id in boms:
+                    continue
+                boms.add(bom_id)
+                for input_ in graph[bom_id][1]:
+                    if input_.product.id in plan_boms:
+                        to_walk.append(plan_boms[input_.product.id].id)
+        return result
+
+    @classmethod
+    def _get_stale_query(cls):
+        "Returns a query of the ids of the stale plans"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        BOMDigest = pool.get('product.cost.plan.bom_digest')
+        plan = cls.__table__()
+        bom = BOM.__table__()
+        digest = BOMDigest.__table__()
+        computed = BOMDigest.__table__()
+
+        changed = digest.join(bom, 'LEFT',
+            condition=digest.bom == bom.id
+            ).select(digest.plan,
+            where=(bom.id == Null)
+            | (digest.digest == Null)
+            | (bom.cost_plan_digest == Null)
+            | (digest.digest != bom.cost_plan_digest))
+        return plan.select(plan.id,
+            where=plan.id.in_(changed)
+            | ((plan.product != Null) & (plan.bom != Null)
+                & ~plan.id.in_(computed.select(computed.plan))))
+
+    @classmethod
+    def get_stale(cls, plans, name):
+        cursor = Transaction().connection.cursor()
+        plan = cls.__table__()
+
+        query = cls._get_stale_query()
+        stale = set()
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*plan.select(plan.id,
+                    where=plan.id.in_(query)
+                    & fields.SQL_OPERATORS['in'](
+                        plan.id, [p.id for p in sub_plans])))
+            stale.update(i for i, in cursor)
+        return {p.id: p.id in stale for p in plans}
+
+    @classmethod
+    def search_stale(cls, name, clause):
+        values = _searched_booleans(clause)
+        if values == {True, False}:
+            return []
+        elif values == {True}:
+            return [('id', 'in', cls._get_stale_query())]
+        elif values == {False}:
+            return [('id', 'not in', cls._get_stale_query())]
+        return [('id', '=', None)]
+
+    @classmethod
+    def compute_batch(cls, plans, chunk_size=None, workers=None,
+            callback=None):
+        "Computes the plans by chunks and returns their results"
+        transaction = Transaction()
+        if chunk_size is None:
+            chunk_size = COMPUTE_CHUNK_SIZE
+        if workers is None:
+            workers = COMPUTE_WORKERS
+
+        chunks = [[p.id for p in c] for c in grouped_slice(plans, chunk_size)]
+        compute_chunk = partial(cls._compute_chunk, transaction.database.name,
+            transaction.user, transaction.context)
+        results = [None] * len(chunks)
+
+        def done(i):
+            if callback:
+                pending = [p for c in chunks[next_chunk:] for p in c]
+                callback(results[i], pending)
+
+        next_chunk = 0
+        if workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                running = {}
+                while next_chunk < len(chunks) or running:
+                    # Start the chunks only when a worker is free so the
+                    # callback can write on the plans of the pending chunks
+                    while next_chunk < len(chunks) and len(running) < workers:
+                        running[executor.submit(
+                                compute_chunk, chunks[next_chunk])] = (
+                            next_chunk)
+                        next_chunk += 1
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        i = running.pop(future)
+                        results[i] = future.result()
+                        done(i)
+        else:
+            for i, chunk in enumerate(chunks):
+                next_chunk = i + 1
+                results[i] = compute_chunk(chunk)
+                done(i)
+        return results
+
+    @classmethod
+    def _compute_chunk(cls, database_name, user, context, plan_ids):
+        start = time.perf_counter()
+        error = None
+        with Transaction(new=True).start(database_name, user,
+                context=context) as transaction:
+            try:
+                cls._compute(cls.browse(plan_ids))
+            except Exception as exception:
+                transaction.rollback()
+                error = str(exception)
+                logger.exception('Fail to compute cost plans %s', plan_ids)
+                with without_check_access():
+                    cls.write(cls.browse(plan_ids), {
+                            'compute_state': 'failed',
+                            })
+        duration = time.perf_counter() - start
+        logger.info('Computed %d cost plans in %.3fs%s', len(plan_ids),
+            duration, ' with errors' if error else '')
+        return {
+            'plans': plan_ids,
+            'duration': duration,
+            'error': error,
+            }
 
-        to_create = []
+    @classmethod
+    def explode_boms(cls, plans):
+        "Returns the product lines to create for the plans"
+        graph = cls.get_bom_graph(plans)
+        res = []
         for plan in plans:
-            to_create.extend(plan.get_costs())
-        if to_create:
-            CostLine.create(to_create)
+            if plan.product and plan.bom:
+                res.extend(plan.explode_bom(plan.product, plan.bom,
+                        plan.quantity, plan.uom, graph=graph))
+        return res
 
-    def explode_bom(self, product, bom, quantity, uom):
+    @classmethod
+    def get_bom_graph(cls, plans):
+        "Returns the BOMs reachable from the plans and their inputs"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        Input = pool.get('production.bom.input')
+
+        plan_boms = {}
+        for plan in plans:
+            for product_id, bom in plan.get_plan_boms().items():
+                plan_boms.setdefault(product_id, set()).add(bom.id)
+
+        graph = {}
+        to_load = {p.bom.id for p in plans if p.product and p.bom}
+        while to_load:
+            boms = BOM.browse(sorted(to_load))
+            bom_inputs = {b.id: [] for b in boms}
+            for input_ in Input.search([('bom', 'in', list(bom_inputs))]):
+                bom_inputs[input_.bom.id].append(input_)
+            to_load = set()
+            for bom in boms:
+                graph[bom.id] = (bom, bom_inputs[bom.id])
+                for input_ in bom_inputs[bom.id]:
+                    to_load.update(plan_boms.get(input_.product.id, ()))
+            to_load.difference_update(graph)
+        return graph
+
+    def get_plan_boms(self):
+        "Returns a dictionary with the BOM to explode for each product id"
+        return {b.product.id: b.bom for b in self.boms if b.bom}
+
+    @instrumented('Plan.explode_bom')
+    def explode_bom(self, product, bom, quantity, uom, graph=None,
+            plan_boms=None):
         "Returns products for the especified products"
         pool = Pool()
         Input = pool.get('production.bom.input')
         res = []
 
-        plan_boms = {}
-        for plan_bom in self.boms:
-            if plan_bom.bom:
-                plan_boms[plan_bom.product.id] = plan_bom.bom
+        if graph is None:
+            graph = {}
+        if plan_boms is None:
+            plan_boms = self.get_plan_boms()
+        if bom.id in graph:
+            bom, inputs = graph[bom.id]
+        else:
+            inputs = bom.inputs
 
         factor = bom.compute_factor(product, quantity, uom)
 
-        for input_ in bom.inputs:
+        for input_ in inputs:
             product = input_.product
-            if product.id in plan_boms:
+            if product.id in plan_boms and self.rolled_up:
+                line = self.get_sub_assembly_line(input_, factor,
+                    plan_boms[product.id], graph=graph, plan_boms=plan_boms)
+                if line:
+                    line['plan'] = self.id
+                    res.append(line)
+            elif product.id in plan_boms:
                 quantity = Input.compute_quantity(input_, factor)
                 res.extend(self.explode_bom(product, plan_boms[product.id],
-                        quantity, input_.unit))
+                        quantity, input_.unit, graph=graph,
+                        plan_boms=plan_boms))
             else:
                 line = self.get_product_line(input_, factor)
                 if line:
@@ -259,6 +1023,55 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
                     res.append(line)
         return res
 
+    def get_sub_assembly_line(self, input_, factor, bom, graph=None,
+            plan_boms=None):
+        """
+        Returns a dict with values of the line of a rolled-up sub-assembly
+        params:
+            *input_*: Production.bom.input record for the sub-assembly
+            *factor*: The factor to calculate the quantity
+            *bom*: The BOM of the sub-assembly
+        """
+        line = self.get_product_line(input_, factor)
+        if line and not line['party_stock']:
+            line['cost_price'] = round_price(self.get_sub_assembly_cost(
+                    input_.product, bom, input_.unit, graph=graph,
+                    plan_boms=plan_boms))
+        return line
+
+    def get_sub_assembly_cost(self, product, bom, uom, graph=None,
+            plan_boms=None):
+        "Returns the unit cost of the sub-assembly in uom"
+        if graph is None:
+            graph = {}
+        if plan_boms is None:
+            plan_boms = self.get_plan_boms()
+        if bom.id in graph:
+            bom = graph[bom.id][0]
+        for output in bom.outputs:
+            if output.product == product:
+                quantity, unit = output.quantity, output.unit
+                break
+        else:
+            quantity, unit = 1, product.default_uom
+
+        # The cache is cleared when a BOM or a cost price is modified
+        key = (Transaction().context.get('company'), bom.id, product.id,
+            tuple(sorted((p, b.id) for p, b in plan_boms.items())))
+        cost = self._sub_assembly_cost_cache.get(key)
+        if cost is None:
+            cost = Decimal(0)
+            for line in self.explode_bom(product, bom, quantity, unit,
+                    graph=graph, plan_boms=plan_boms):
+                if line['cost_price'] and line['quantity']:
+                    cost += (Decimal(str(line['quantity']))
+                        * line['cost_price'])
+            if quantity:
+                cost /= Decimal(str(quantity))
+            self._sub_assembly_cost_cache.set(key, cost)
+        return compute_price(unit, cost, uom)
+
+    @instrumented('Plan.get_product_line')
     def get_product_line(self, input_, factor):
         """
         Returns a dict with values of the new line to create
@@ -267,19 +1080,16 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
             *factor*: The factor to calculate the quantity
         """
         pool = Pool()
-        UoM = pool.get('product.uom')
         Input = pool.get('production.bom.input')
+        ProductLine = pool.get('product.cost.plan.product_line')
 
         quantity = Input.compute_quantity(input_, factor)
         party_stock = getattr(input_, 'party_stock', False)
-        product_cost_price = Decimal(0)
+        product_cost_price = ProductLine.compute_product_cost_price(
+            input_.product, input_.unit)
         cost_price = Decimal(0)
-        cost_factor = Decimal(
-            UoM.compute_qty(input_.product.default_uom, 1, input_.unit))
-        if cost_factor != Decimal(0):
-            product_cost_price = Decimal(input_.product.cost_price / cost_factor)
-            if not party_stock:
-                cost_price = product_cost_price
+        if not party_stock:
+            cost_price = product_cost_price
 
         return {
             'name': input_.product.rec_name,
@@ -287,21 +1097,20 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
             'quantity': quantity,
             'uom': input_.unit.id,
             'party_stock': getattr(input_, 'party_stock', False),
-            'product_cost_price': round_price(product_cost_price),
-            'cost_price': round_price(cost_price),
+            'product_cost_price': product_cost_price,
+            'cost_price': cost_price,
             }
 
+    @instrumented('Plan.get_costs')
     def get_costs(self):
         "Returns the cost lines to be created on compute"
         pool = Pool()
         CostType = pool.get('product.cost.plan.cost.type')
 
         ret = []
-        system_cost_types = CostType.search([
-                ('system', '=', True),
-                ])
-        for cost_type in system_cost_types:
-            ret.append(self._get_cost_line(cost_type))
+        for type_id, field_name in CostType.get_system_types().items():
+            ret.append(self._get_cost_line(CostType(type_id, system=True,
+                        plan_field_name=field_name)))
         return ret
 
     def _get_cost_line(self, cost_type):
@@ -312,66 +1121,275 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
             'internal_cost': Decimal('0'),
             }
 
+    @classmethod
+    def price_curve(cls, plans, quantities):
+        "Returns the price curve of each plan for the quantities"
+        return [{
+                'plan': plan.id,
+                'curve': plan.get_price_curve(quantities),
+                } for plan in plans]
+
+    def get_price_curve(self, quantities):
+        "Returns the costs of the plan for each quantity"
+        pool = Pool()
+        CostType = pool.get('product.cost.plan.cost.type')
+
+        quantities = list(quantities)
+        products_costs = [Decimal(0)] * len(quantities)
+        if self.product and self.bom:
+            graph = self.get_bom_graph([self])
+            tree = self._get_price_curve_tree(self.product, self.bom,
+                self.uom, graph, self.get_plan_boms())
+            products_costs = self._evaluate_price_curve_tree(tree,
+                quantities)
+
+        system_types = CostType.get_system_types()
+        other_costs = Decimal(0)
+        for cost in self.costs:
+            if (cost.system
+                    and system_types.get(cost.type.id) == 'products_cost'):
+                continue
+            other_costs += cost.cost or 0
+        curve = []
+        for quantity, products_cost in zip(quantities, products_costs):
+            if quantity:
+                products_cost /= Decimal(str(quantity))
+            products_cost = round_price(products_cost)
+            curve.append({
+                    'quantity': quantity,
+                    'products_cost': products_cost,
+                    'cost_price': products_cost + other_costs,
+                    })
+        return curve
+
+    def _get_price_curve_tree(self, product, bom, uom, graph, plan_boms):
+        "Returns the tree of the inputs and their cost price"
+        if bom.id in graph:
+            bom, inputs = graph[bom.id]
+        else:
+            inputs = bom.inputs
+        children = []
+        for input_ in inputs:
+            if input_.product.id in plan_boms and not self.rolled_up:
+                children.append((input_, self._get_price_curve_tree(
+                            input_.product, plan_boms[input_.product.id],
+                            input_.unit, graph, plan_boms)))
+                continue
+            if input_.product.id in plan_boms:
+                line = self.get_sub_assembly_line(input_, 1,
+                    plan_boms[input_.product.id], graph=graph,
+                    plan_boms=plan_boms)
+            else:
+                line = self.get_product_line(input_, 1)
+            if line:
+                children.append((input_, line['cost_price']))
+        return bom, product, uom, children
+
+    @classmethod
+    def _evaluate_price_curve_tree(cls, tree, quantities):
+        "Returns the total cost of the tree for each quantity"
+        pool = Pool()
+        Input = pool.get('production.bom.input')
+
+        bom, product, uom, children = tree
+        factors = [bom.compute_factor(product, q, uom) for q in quantities]
+        costs = [Decimal(0)] * len(quantities)
+        for input_, child in children:
+            input_quantities = [Input.compute_quantity(input_, f)
+                for f in factors]
+            if isinstance(child, tuple):
+                child_costs = cls._evaluate_price_curve_tree(child,
+                    input_quantities)
+            else:
+                child_costs = [Decimal(str(q)) * child if q and child
+                    else Decimal(0) for q in input_quantities]
+            costs = [c + t for c, t in zip(costs, child_costs)]
+        return costs
+
+    @classmethod
+    def simulate(cls, product, quantity, uom=None, bom=None, boms=None,
+            rolled_up=False):
+        """
+        Returns the cost breakdown of the quantity of product without saving
+        params:
+            *product*: The product id
+            *quantity*: The quantity in uom
+            *uom*: The unit id, the default unit of the product if not set
+            *bom*: The BOM id, the first BOM of the product if not set
+            *boms*: A dictionary with the BOM id to explode by sub-assembly
+                product id
+            *rolled_up*: Use the unit cost of the sub-assemblies
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        BOM = pool.get('production.bom')
+        PlanBOM = pool.get('product.cost.plan.bom_line')
+        CostType = pool.get('product.cost.plan.cost.type')
+
+        product = Product(product)
+        plan = cls(product=product, quantity=quantity,
+            uom=Uom(uom) if uom else product.default_uom,
+            rolled_up=rolled_up)
+        bom = bom or plan.on_change_with_bom()
+        plan.bom = BOM(bom) if bom else None
+        plan.boms = [PlanBOM(product=int(p), bom=BOM(b))
+            for p, b in (boms or {}).items()]
+
+        lines = []
+        if plan.bom:
+            lines = plan.explode_bom(plan.product, plan.bom, plan.quantity,
+                plan.uom)
+        products_cost = Decimal(0)
+        for line in lines:
+            del line['plan']
+            total_cost = Decimal(0)
+            if line['cost_price'] and line['quantity']:
+                total_cost = (Decimal(str(line['quantity']))
+                    * line['cost_price'])
+            products_cost += total_cost
+            line['total_cost'] = round_price(total_cost)
+            line['unit_cost'] = line['total_cost']
+            if line['unit_cost'] and plan.quantity:
+                line['unit_cost'] = round_price(
+                    line['unit_cost'] / Decimal(str(plan.quantity)))
+        if plan.quantity:
+            products_cost /= Decimal(str(plan.quantity))
+        plan.products_cost = round_price(products_cost)
+
+        costs = []
+        system_types = CostType.get_system_types()
+        for cost_type in CostType.browse(list(system_types)):
+            cost = round_price(
+                getattr(plan, system_types[cost_type.id]) or 0)
+            costs.append({
+                    'type': cost_type.id,
+                    'name': cost_type.rec_name,
+                    'cost': cost,
+                    })
+        return {
+            'product': product.id,
+            'quantity': plan.quantity,
+            'uom': plan.uom.id,
+            'bom': plan.bom.id if plan.bom else None,
+            'products_cost': plan.products_cost,
+            'cost_price': sum((c['cost'] for c in costs), Decimal(0)),
+            'costs': costs,
+            'lines': lines,
+            }
+
     @classmethod
     @ModelView.button
     def update_product_cost_price(cls, plans):
+        "Updates the cost price of the products of the plans"
+        to_update = defaultdict(dict)
+        to_save = defaultdict(list)
         for plan in plans:
             if not plan.product:
                 continue
+            record = plan._get_cost_price_record()
+            old_cost_price = record.cost_price
             plan._update_product_cost_price()
-            plan.product.save()
-            plan.product.template.save()
+            for changed in [plan.product, plan.product.template]:
+                # The other values set by the hook are saved like before
+                if set(changed._values or {}) - {'cost_price'}:
+                    to_save[changed.__class__].append(changed)
+            # When many plans are for the same product, the last one wins
+            to_update[record.__class__][record] = (
+                old_cost_price, record.cost_price)
+
+        for Model, records in to_save.items():
+            Model.save(records)
+        for Model, record2prices in to_update.items():
+            records = defaultdict(list)
+            for record, (old_cost_price, cost_price) in record2prices.items():
+                if cost_price != old_cost_price:
+                    records[cost_price].append(record)
+            to_write = []
+            for cost_price, sub_records in records.items():
+                to_write.extend((sub_records, {'cost_price': cost_price}))
+            if to_write:
+                Model.write(*to_write)
+
+    def _get_product_cost_price(self):
+        "Returns the cost price of the plan in the unit of the product"
+        assert self.product
+        return round_price(compute_price(self.uom, self.cost_price,
+                self.product.default_uom))
 
-    def _update_product_cost_price(self):
-        pool = Pool()
-        Uom = pool.get('product.uom')
+    def _get_cost_price_record(self):
+        "Returns the product or the template which stores the cost price"
+        Product = Pool().get('product.product')
+        if hasattr(Product, 'cost_price'):
+            return self.product
+        return self.product.template
 
-        assert self.product
-        cost_price = Uom.compute_price(self.uom, self.cost_price,
-            self.product.default_uom)
-        if hasattr(self.product.__class__, 'cost_price'):
-            self.product.cost_price = round_price(cost_price)
-        else:
-            self.product.template.cost_price = round_price(cost_price)
+    def _update_product_cost_price(self):
+        "Sets the cost price of the plan on the product or its template"
+        record = self._get_cost_price_record()
+        record.cost_price = self._get_product_cost_price()
 
+    @instrumented('Plan.create_bom')
     def create_bom(self, name):
+        bom, = self.create_boms([self], name=name)
+        return bom
+
+    @classmethod
+    @instrumented('Plan.create_boms')
+    def create_boms(cls, plans, name=None):
+        "Creates a BOM for each plan"
         pool = Pool()
         BOM = pool.get('production.bom')
         ProductBOM = pool.get('product.product-production.bom')
         Warning = pool.get('res.user.warning')
-        key = 'not_product_%s' % self.id,
-        if not self.product and Warning.check(key):
-            raise UserWarning(key,
-                gettext('product_cost_plan.lacks_the_product',
-                    cost_plan=self.rec_name))
-        key = 'bom_already_exists%s' % self.id
-        if self.bom and Warning.check(key):
-            raise UserWarning(key,
-                gettext('product_cost_plan.bom_already_exists',
-                    cost_plan=self.rec_name))
-
-        bom = BOM()
-        bom.name = name
-        bom.inputs = self._get_bom_inputs()
-        bom.outputs = self._get_bom_outputs()
-        bom.save()
-        self.bom = bom
-        self.save()
 
-        if self.product.boms:
-            # TODO: create new bom to allow diferent "versions"?
-            product_bom = self.product.boms[0]
-            key = 'product_already_has_bom%s' % self.id
-            if product_bom.bom and Warning.check(key):
+        for plan in plans:
+            key = 'not_product_%s' % plan.id
+            if not plan.product and Warning.check(key):
                 raise UserWarning(key,
-                    gettext('product_cost_plan.product_already_has_bom',
-                    product=self.product.rec_name))
-        else:
-            product_bom = ProductBOM()
-        product_bom.product = self.product
-        product_bom.bom = bom
-        product_bom.save()
-        return bom
+                    gettext('product_cost_plan.lacks_the_product',
+                        cost_plan=plan.rec_name))
+            key = 'bom_already_exists%s' % plan.id
+            if plan.bom and Warning.check(key):
+                raise UserWarning(key,
+                    gettext('product_cost_plan.bom_already_exists',
+                        cost_plan=plan.rec_name))
+            if plan.product and plan.product.boms:
+                # TODO: create new bom to allow diferent "versions"?
+                product_bom = plan.product.boms[0]
+                key = 'product_already_has_bom%s' % plan.id
+                if product_bom.bom and Warning.check(key):
+                    raise UserWarning(key,
+                        gettext('product_cost_plan.product_already_has_bom',
+                        product=plan.product.rec_name))
+
+        plans_inputs = cls._get_boms_inputs(plans)
+        boms = []
+        for plan in plans:
+            bom = BOM()
+            bom.name = name or plan.rec_name
+            bom.inputs = plans_inputs[plan.id]
+            bom.outputs = plan._get_bom_outputs()
+            boms.append(bom)
+        BOM.save(boms)
+
+        to_write = []
+        product_boms = []
+        for plan, bom in zip(plans, boms):
+            to_write.extend(([plan], {'bom': bom.id}))
+            if not plan.product:
+                continue
+            if plan.product.boms:
+                product_bom = plan.product.boms[0]
+            else:
+                product_bom = ProductBOM()
+            product_bom.product = plan.product
+            product_bom.bom = bom
+            product_boms.append(product_bom)
+        if to_write:
+            cls.write(*to_write)
+        ProductBOM.save(product_boms)
+        return boms
 
     def _get_bom_outputs(self):
         BOMOutput = Pool().get('production.bom.output')
@@ -384,36 +1402,143 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
             outputs.append(output)
         return outputs
 
+    @classmethod
+    def get_breakdown(cls, plans, batch_size=None):
+        "Yields the product lines of the plans in tree order"
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
+
+        if batch_size is None:
+            batch_size = EXPORT_BATCH_SIZE
+        fields_names = ['name', 'parent', 'quantity', 'product.rec_name',
+            'uom.symbol', 'product_cost_price', 'cost_price']
+        for plan in plans:
+            roots = ProductLine.search([
+                    ('plan', '=', plan.id),
+                    ])
+            for sub_roots in grouped_slice(roots, batch_size):
+                root_ids = [r.id for r in sub_roots]
+                children = defaultdict(list)
+                # The roots are found by child_of with their descendants
+                for line in ProductLine.search_read([
+                            ('parent', 'child_of', root_ids),
+                            ], fields_names=fields_names):
+                    children[line['parent']].append(line)
+                for root in children.pop(None, []):
+                    # Depth first with the quantities of the ancestors
+                    stack = [(root, ())]
+                    while stack:
+                        line, ancestors = stack.pop()
+                        yield cls._get_breakdown_row(plan, line, ancestors)
+                        ancestors = (line['quantity'],) + ancestors
+                        for child in reversed(children.pop(line['id'], [])):
+                            stack.append((child, ancestors))
+
+    @classmethod
+    def _get_breakdown_row(cls, plan, line, ancestors):
+        # Quantity is the quantity of this line for all plan's quantity
+        quantity = line['quantity']
+        for parent_quantity in ancestors:
+            if not quantity:
+                break
+            quantity *= parent_quantity
+
+        cost_price = line['cost_price']
+        if not cost_price or not quantity:
+            total_cost = Decimal(0)
+        else:
+            total_cost = round_price(Decimal(str(quantity)) * cost_price)
+        unit_cost = total_cost
+        if unit_cost and plan.quantity:
+            unit_cost /= Decimal(str(plan.quantity))
+        product = line['product.']
+        uom = line['uom.']
+        return {
+            'plan': plan.rec_name,
+            'line': line['id'],
+            'level': len(ancestors),
+            'name': line['name'],
+            'product': product['rec_name'] if product else None,
+            'quantity': line['quantity'],
+            'uom': uom['symbol'] if uom else None,
+            'product_cost_price': line['product_cost_price'],
+            'cost_price': cost_price,
+            'unit_cost': round_price(unit_cost or 0),
+            'total_cost': total_cost,
+            }
+
+    @classmethod
+    def write_breakdown(cls, plans, file, format_='csv', batch_size=None):
+        "Writes the breakdown of the plans in the file"
+        text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        try:
+            if format_ == 'csv':
+                writer = csv.DictWriter(text, BREAKDOWN_COLUMNS)
+                writer.writeheader()
+                for row in cls.get_breakdown(plans, batch_size=batch_size):
+                    row['name'] = '  ' * row['level'] + (row['name'] or '')
+                    writer.writerow(row)
+            else:
+                for row in cls.get_breakdown(plans, batch_size=batch_size):
+                    text.write(json.dumps(row, default=str) + '\n')
+        finally:
+            text.flush()
+            text.detach()
+
     @classmethod
     def get_all_inputs(cls, lines):
-        lines = [x for x in lines]
-        for line in lines:
-            if not line.children:
-                continue
-            lines += cls.get_all_inputs(line.children)
-        return list(set(lines))
+        "Returns the lines and all their descendants"
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
+
+        lines = list(set(lines))
+        if not lines:
+            return lines
+        # Only the lines with children need a lookup on the path
+        parents = {c.parent for c in ProductLine.search([
+                    ('parent', 'in', [l.id for l in lines]),
+                    ])}
+        if parents:
+            lines += set(ProductLine.search([
+                        ('parent', 'child_of', [p.id for p in parents]),
+                        ])) - set(lines)
+        return lines
 
     def _get_bom_inputs(self):
-        pool = Pool()
-        Uom = pool.get('product.uom')
-        Plan = pool.get('product.cost.plan')
+        return self._get_boms_inputs([self])[self.id]
 
-        inputs = {}
-        lines = Plan.get_all_inputs(self.products)
-        for line in lines:
-            if not line.product:
-                continue
-            input_ = self._get_input_line(line)
-            if input_.product.id not in inputs:
-                inputs[input_.product.id] = input_
-                continue
-            existing = inputs[input_.product.id]
-            existing.quantity += Uom.compute_qty(input_.unit, input_.quantity,
-                existing.uom)
-        return list(inputs.values())
+    @classmethod
+    def _get_boms_inputs(cls, plans):
+        "Returns the BOM inputs of each plan id"
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
 
-    def _get_input_line(self, line):
-        'Return the BOM Input line for a product line'
+        id2plan = {p.id: p for p in plans}
+        plans_inputs = {p.id: {} for p in plans}
+        ancestors = {None: ()}
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            lines = ProductLine.search([
+                    ('root_plan', 'in', [p.id for p in sub_plans]),
+                    ], order=[('path', 'ASC'), ('id', 'ASC')])
+            for line in lines:
+                parent = line.parent.id if line.parent else None
+                line_ancestors = ancestors[parent]
+                ancestors[line.id] = (line.quantity,) + line_ancestors
+                if not line.product:
+                    continue
+                plan = id2plan[line.root_plan.id]
+                inputs = plans_inputs[plan.id]
+                input_ = plan._get_input_line(line, ancestors=line_ancestors)
+                if input_.product.id not in inputs:
+                    inputs[input_.product.id] = input_
+                    continue
+                existing = inputs[input_.product.id]
+                existing.quantity += compute_qty(input_.unit, input_.quantity,
+                    existing.unit)
+        return {i: list(inputs.values()) for i, inputs in plans_inputs.items()}
+
+    def _get_input_line(self, line, ancestors=None):
+        "Return the BOM Input line for a product line"
         BOMInput = Pool().get('production.bom.input')
         input_ = BOMInput()
         input_.product = line.product
@@ -421,11 +1546,16 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
         input_.quantity = line.quantity
         if hasattr(BOMInput, 'party_stock'):
             input_.party_stock = line.party_stock
-        parent_line = line.parent
-        while parent_line:
+        if ancestors is None:
+            ancestors = []
+            parent_line = line.parent
+            while parent_line:
+                ancestors.append(parent_line.quantity)
+                parent_line = parent_line.parent
+        # The quantity is rounded at each level
+        for parent_quantity in ancestors:
             input_.quantity = input_.unit.round(input_.quantity *
-                parent_line.quantity)
-            parent_line = parent_line.parent
+                parent_quantity)
         return input_
 
     @classmethod
@@ -445,26 +1575,23 @@ class Plan(DeactivableMixin, ModelSQL, ModelView):
         else:
             default = default.copy()
         default.setdefault('bom', None)
+        default.setdefault('compute_state', None)
+        default.setdefault('compute_progress', None)
+        default.setdefault('compute_duration', None)
+        default.setdefault('compute_statistics', None)
+        default.setdefault('snapshots', None)
+        default.setdefault('bom_digests', None)
 
         return super().copy(plans, default=default)
 
     @classmethod
     def delete(cls, plans):
-        pool = Pool()
-        CostLine = pool.get('product.cost.plan.cost')
-        Line = pool.get('product.cost.plan.product_line')
+        with Transaction().set_context(reset_costs=True,
+                skip_update_costs=True):
+            cls._delete_costs(plans)
+            cls._delete_product_lines(plans)
 
-        to_delete = []
-        to_delete2 = []
-        for plan in plans:
-            to_delete += plan.costs
-            to_delete2 += [line for line in plan.all_products
-                if line.plan is None]
-        with Transaction().set_context(reset_costs=True):
-            CostLine.delete(to_delete)
-            Line.delete(to_delete2)
-
-        super(Plan, cls).delete(plans)
+            super(Plan, cls).delete(plans)
 
 
 class PlanBOM(ModelSQL, ModelView):
@@ -478,6 +1605,23 @@ class PlanBOM(ModelSQL, ModelView):
             ('output_products', '=', Eval('product', 0)),
             ])
 
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        BOMDigest = pool.get('product.cost.plan.bom_digest')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        super().on_modification(mode, lines, field_names=field_names)
+        # The plans must be computed again with the new overrides
+        plan_ids = set()
+        for sub_lines in grouped_slice(lines, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.plan,
+                    where=fields.SQL_OPERATORS['in'](
+                        table.id, [l.id for l in sub_lines])))
+            plan_ids.update(i for i, in cursor)
+        BOMDigest.clear(Plan.browse(list(plan_ids)))
+
 
 class PlanProductLine(ModelSQL, ModelView, tree(separator='/')):
     'Product Cost Plan Product Line'
@@ -485,10 +1629,15 @@ class PlanProductLine(ModelSQL, ModelView, tree(separator='/')):
 
     name = fields.Char('Name')
     sequence = fields.Integer('Sequence')
-    parent = fields.Many2One('product.cost.plan.product_line', 'Parent')
+    parent = fields.Many2One('product.cost.plan.product_line', 'Parent',
+        path='path')
+    path = fields.Char('Path', readonly=True)
     children = fields.One2Many('product.cost.plan.product_line', 'parent',
         'Children')
     plan = fields.Many2One('product.cost.plan', 'Plan', ondelete='CASCADE')
+    root_plan = fields.Many2One('product.cost.plan', 'Root Plan',
+        readonly=True, ondelete='CASCADE',
+        help='The plan of the root line, stored on all the lines.')
     product = fields.Many2One('product.product', 'Product', domain=[
         ('type', '!=', 'service'),
         ])
@@ -515,15 +1664,36 @@ class PlanProductLine(ModelSQL, ModelView, tree(separator='/')):
         digits=price_digits)
     unit_cost = fields.Function(fields.Numeric('Unit Cost', digits=price_digits,
         help="The cost of this product for each unit of plan's product."),
-        'get_unit_cost')
+        'get_line_costs')
     total_cost = fields.Function(fields.Numeric('Total Cost', digits=price_digits,
         help="The cost of this product for total plan's quantity."),
-        'get_total_cost')
+        'get_line_costs')
 
     @classmethod
     def __setup__(cls):
         super(PlanProductLine, cls).__setup__()
         cls._order.insert(0, ('sequence', 'ASC'))
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.product, Index.Range()),
+                    (t.root_plan, Index.Range()),
+                    where=t.product != Null),
+                Index(t, (t.plan, Index.Range()),
+                    (t.sequence, Index.Range())),
+                Index(t, (t.root_plan, Index.Range())),
+                Index(t, (t.path, Index.Similarity(begin=True))),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_root_plan = not table_h.column_exist('root_plan')
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: store the plan of the root line
+        if fill_root_plan:
+            cls._update_root_plan()
 
     @staticmethod
     def order_sequence(tables):
@@ -566,26 +1736,22 @@ class PlanProductLine(ModelSQL, ModelView, tree(separator='/')):
 
     @fields.depends('party_stock', 'cost_price', 'product', 'uom')
     def on_change_party_stock(self):
-        UoM = Pool().get('product.uom')
-
         if self.party_stock:
             self.cost_price = Decimal(0)
             return
         if not self.cost_price and self.product and self.uom:
-            cost = UoM.compute_price(self.product.default_uom,
+            cost = compute_price(self.product.default_uom,
                 self.product.cost_price, self.uom)
             self.cost_price = round_price(cost)
 
     @fields.depends('product', 'uom', 'cost_price')
     def on_change_with_cost_price(self):
-        UoM = Pool().get('product.uom')
-
         if (not self.product or not self.uom
                 or (self.cost_price != None
                     and self.cost_price != self.product.cost_price)):
             cost = self.cost_price
         else:
-            cost = UoM.compute_price(self.product.default_uom,
+            cost = compute_price(self.product.default_uom,
                 self.product.cost_price, self.uom)
         if cost:
             return round_price(cost)
@@ -593,45 +1759,330 @@ class PlanProductLine(ModelSQL, ModelView, tree(separator='/')):
 
     @fields.depends('product', 'uom')
     def on_change_with_product_cost_price(self):
-        UoM = Pool().get('product.uom')
         if not self.product:
             return
         if not self.uom:
             cost = self.product.cost_price
         else:
-            cost = UoM.compute_price(self.product.default_uom,
+            cost = compute_price(self.product.default_uom,
                 self.product.cost_price, self.uom)
         return round_price(cost or 0)
 
-    def get_plan(self):
-        if self.plan:
-            return self.plan
-        elif self.parent:
-            return self.parent.get_plan()
+    @classmethod
+    def bulk_create(cls, vlist):
+        "Creates root lines and returns their ids"
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        ModelAccess.check(cls.__name__, 'create')
+        for values in vlist:
+            if not values.get('plan') or values.get('parent'):
+                raise ValidationError(gettext(
+                        'product_cost_plan.msg_product_line_plan_parent',
+                        line=values.get('name')))
+        vlist = [dict(v, root_plan=v['plan']) for v in vlist]
+
+        names = set().union(*vlist) - {
+            'id', 'create_uid', 'create_date', 'write_uid', 'write_date'}
+        defaults = cls._clean_defaults(cls.default_get(
+                [n for n, f in cls._fields.items()
+                    if n not in names and not hasattr(f, 'set')
+                    and n not in {'id', 'create_uid', 'create_date',
+                        'write_uid', 'write_date'}],
+                with_rec_name=False))
+        names = sorted((names | defaults.keys())
+            - {n for n, f in cls._fields.items() if hasattr(f, 'set')})
+        columns = [table.create_uid, table.create_date] + [
+            Column(table, n) for n in names]
+        rows = []
+        for values in vlist:
+            rows.append([transaction.user, CurrentTimestamp()] + [
+                    cls._fields[n].sql_format(values.get(n, defaults.get(n)))
+                    for n in names])
+
+        new_ids = []
+        for sub_rows in grouped_slice(
+                rows, backend.MAX_QUERY_PARAMS // (len(columns) + 1)):
+            sub_rows = list(sub_rows)
+            ids = database.nextid(
+                transaction.connection, cls._table, count=len(sub_rows))
+            if ids is not None:
+                cursor.execute(*table.insert(columns + [table.id],
+                        [r + [i] for r, i in zip(sub_rows, ids)]))
+                new_ids.extend(ids)
+            else:
+                for row in sub_rows:
+                    cursor.execute(*table.insert(columns, [row]))
+                    new_ids.append(database.lastid(cursor))
+
+        cls._set_path(['parent'], [new_ids])
+        transaction.create_records[cls.__name__].extend(new_ids)
+        cls.on_modification('create', cls.browse(new_ids))
+        return new_ids
+
+    @classmethod
+    def compute_product_cost_price(cls, product, uom):
+        "Returns the cost price of the product in the uom"
+        cost_factor = Decimal(compute_factor(product.default_uom, uom))
+        if cost_factor == Decimal(0):
+            return Decimal(0)
+        return round_price(Decimal(product.cost_price / cost_factor))
+
+    @classmethod
+    def update_product_cost_price(cls, products):
+        "Updates the cost prices of the lines of the products"
+        to_write = []
+        lines = cls.search([
+                ('product', 'in', [p.id for p in products]),
+                ])
+        for line in lines:
+            product_cost_price = cls.compute_product_cost_price(
+                line.product, line.uom)
+            if product_cost_price == line.product_cost_price:
+                continue
+            values = {
+                'product_cost_price': product_cost_price,
+                }
+            if (not line.party_stock
+                    and line.cost_price == line.product_cost_price):
+                values['cost_price'] = product_cost_price
+            to_write.extend(([line], values))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def _update_root_plan(cls, lines=None):
+        "Stores the plan of the root line on the lines"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        paths = {}
+        if lines is None:
+            cursor.execute(*table.select(table.id, table.path,
+                    where=table.parent == Null))
+            paths.update(cursor)
+        else:
+            for sub_lines in grouped_slice(lines, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.select(table.id, table.path,
+                        where=fields.SQL_OPERATORS['in'](
+                            table.id, [l.id for l in sub_lines])))
+                paths.update(cursor)
+
+        # The descendants of a path are contiguous once sorted
+        prefixes = []
+        for path in sorted(filter(None, paths.values())):
+            if not prefixes or not path.startswith(prefixes[-1]):
+                prefixes.append(path)
+
+        def root_id(path):
+            return int(path.split('/', 1)[0])
+
+        root_plans = {}
+        root_ids = {root_id(p) for p in prefixes}
+        for sub_ids in grouped_slice(root_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.id, table.plan,
+                    where=fields.SQL_OPERATORS['in'](table.id, list(sub_ids))))
+            root_plans.update(cursor)
+
+        for path in prefixes:
+            plan = root_plans.get(root_id(path))
+            if plan is None:
+                changed = table.root_plan != Null
+            else:
+                changed = ((table.root_plan != plan)
+                    | (table.root_plan == Null))
+            cursor.execute(*table.update([table.root_plan], [plan],
+                    where=table.path.like(path + '%') & changed))
 
     def get_unit_cost(self, name):
-        unit_cost = self.total_cost
-        plan = self.get_plan()
-        if unit_cost and plan and plan.quantity:
-            unit_cost /= Decimal(str(plan.quantity))
-        return round_price(unit_cost or 0)
+        return self.get_line_costs([self], [name])[name][self.id]
 
     def get_total_cost(self, name, round=True):
-        if not self.cost_price:
-            return Decimal(0)
-        # Quantity is the quantity of this line for all plan's quantity
-        quantity = self.quantity
-        line = self
-        while quantity and line.parent:
-            quantity *= line.parent.quantity
-            line = line.parent
-        if not quantity:
-            return Decimal(0)
+        return self.get_total_costs([self], round=round)[self.id]
+
+    @classmethod
+    def _get_tree_values(cls, lines):
+        "Returns the values of the lines and their ancestors by id"
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ModelAccess.check(cls.__name__, 'read')
+        values = {}
+        ids = {l.id for l in lines}
+        while ids:
+            for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.select(table.id, table.parent,
+                        table.plan, table.quantity, table.cost_price,
+                        table.path,
+                        where=fields.SQL_OPERATORS['in'](
+                            table.id, list(sub_ids))))
+                for id_, parent, plan, quantity, cost_price, path in cursor:
+                    values[id_] = {
+                        'id': id_,
+                        'parent': parent,
+                        'plan': plan,
+                        'quantity': quantity,
+                        'cost_price': cost_price,
+                        'path': path,
+                        }
+            ids = {int(i) for v in values.values()
+                for i in (v['path'] or '').split('/')[:-1]} - values.keys()
+        return values
+
+    @classmethod
+    def _get_line_quantities(cls, lines, tree_values):
+        "Returns the quantity and cost price of the lines by id"
+        quantities = {}
+        for line in lines:
+            values = tree_values[line.id]
+            cost_price = values['cost_price']
+            quantity = values['quantity']
+            while quantity and values['parent'] is not None:
+                values = tree_values[values['parent']]
+                quantity *= values['quantity']
+            if cost_price and quantity:
+                quantities[line.id] = (quantity, cost_price)
+        return quantities
 
-        total_cost = Decimal(str(quantity)) * self.cost_price
-        if not round:
-            return total_cost
-        return round_price(total_cost or 0)
+    @classmethod
+    def get_total_costs(cls, lines, round=True, tree_values=None):
+        "Returns the total cost of the lines by id like get_total_cost"
+        if tree_values is None:
+            tree_values = cls._get_tree_values(lines)
+        quantities = cls._get_line_quantities(lines, tree_values)
+        decimals = {}
+        costs = {}
+        for line in lines:
+            if line.id not in quantities:
+                costs[line.id] = Decimal(0)
+                continue
+            quantity, cost_price = quantities[line.id]
+            if quantity not in decimals:
+                decimals[quantity] = Decimal(str(quantity))
+            total_cost = decimals[quantity] * cost_price
+            if round:
+                total_cost = round_price(total_cost or 0)
+            costs[line.id] = total_cost
+        return costs
+
+    @classmethod
+    def sum_total_costs(cls, lines, tree_values=None):
+        "Returns the unrounded sum of the total cost of the lines"
+        if tree_values is None:
+            tree_values = cls._get_tree_values(lines)
+        cost_prices = defaultdict(Decimal)
+        for quantity, cost_price in cls._get_line_quantities(
+                lines, tree_values).values():
+            cost_prices[quantity] += cost_price
+        return sum((Decimal(str(q)) * c for q, c in cost_prices.items()),
+            Decimal(0))
+
+    @classmethod
+    @instrumented('PlanProductLine.get_line_costs')
+    def get_line_costs(cls, lines, names):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+
+        tree_values = cls._get_tree_values(lines)
+        total_costs = cls.get_total_costs(lines, tree_values=tree_values)
+
+        line2plan = {}
+        for line in lines:
+            values = tree_values[line.id]
+            while values['plan'] is None and values['parent'] is not None:
+                values = tree_values[values['parent']]
+            line2plan[line.id] = values['plan']
+        plan_quantities = {p['id']: p['quantity'] for p in Plan.read(
+                list({p for p in line2plan.values() if p is not None}),
+                ['quantity'])}
+
+        result = {n: {} for n in names}
+        for line in lines:
+            total_cost = total_costs[line.id]
+            if 'total_cost' in result:
+                result['total_cost'][line.id] = total_cost
+            if 'unit_cost' in result:
+                unit_cost = total_cost
+                plan_quantity = plan_quantities.get(line2plan[line.id])
+                if unit_cost and plan_quantity:
+                    unit_cost /= Decimal(str(plan_quantity))
+                result['unit_cost'][line.id] = round_price(unit_cost or 0)
+        return result
+
+    @classmethod
+    def _get_cost_plans(cls, lines):
+        "Returns the ids of the plans which costs depend on the lines"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        plan_ids = set()
+        for sub_lines in grouped_slice(lines, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.root_plan,
+                    where=fields.SQL_OPERATORS['in'](
+                        table.id, [l.id for l in sub_lines])
+                    & (table.root_plan != Null)))
+            plan_ids.update(i for i, in cursor)
+        return plan_ids
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        parents = cls.browse(list({v['parent'] for v in vlist
+                    if not v.get('plan') and v.get('parent')}))
+        root_plans = {p.id: p.root_plan.id if p.root_plan else None
+            for p in parents}
+        for values in vlist:
+            if values.get('plan'):
+                values['root_plan'] = values['plan']
+            else:
+                values['root_plan'] = root_plans.get(values.get('parent'))
+        return super().create(vlist)
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        super().on_modification(mode, lines, field_names=field_names)
+        if mode == 'write' and field_names & {'plan', 'parent'}:
+            cls._update_root_plan(lines)
+        if (mode == 'delete'
+                or Transaction().context.get('skip_update_costs')
+                or (field_names is not None and not field_names & {
+                        'plan', 'parent', 'quantity', 'cost_price'})):
+            return
+        Plan.store_costs(Plan.browse(cls._get_cost_plans(lines)))
+
+    @classmethod
+    def on_write(cls, lines, values):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        callback = super().on_write(lines, values)
+        if (values.keys() & {'plan', 'parent'}
+                and not Transaction().context.get('skip_update_costs')):
+            plan_ids = list(cls._get_cost_plans(lines))
+            if plan_ids:
+                callback.append(lambda: Plan.store_costs(Plan.search([
+                                ('id', 'in', plan_ids),
+                                ])))
+        return callback
+
+    @classmethod
+    def on_delete(cls, lines):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        callback = super().on_delete(lines)
+        if not Transaction().context.get('skip_update_costs'):
+            plan_ids = list(cls._get_cost_plans(lines))
+            if plan_ids:
+                callback.append(lambda: Plan.store_costs(Plan.search([
+                                ('id', 'in', plan_ids),
+                                ])))
+        return callback
 
     @classmethod
     def validate(cls, lines):
@@ -689,12 +2140,24 @@ class PlanCost(ModelSQL, ModelView):
     def default_system():
         return False
 
-    def get_cost(self, name):
-        if self.system:
-            cost = getattr(self.plan, self.type.plan_field_name)
-        else:
-            cost = self.internal_cost
-        return round_price(cost)
+    @classmethod
+    @instrumented('PlanCost.get_cost')
+    def get_cost(cls, costs, name):
+        pool = Pool()
+        CostType = pool.get('product.cost.plan.cost.type')
+
+        system_types = CostType.get_system_types()
+        result = {}
+        for cost in costs:
+            if cost.system:
+                field_name = system_types.get(cost.type.id)
+                if field_name is None:
+                    field_name = cost.type.plan_field_name
+                value = getattr(cost.plan, field_name)
+            else:
+                value = cost.internal_cost
+            result[cost.id] = round_price(value)
+        return result
 
     @classmethod
     def set_cost(cls, records, name, value):
@@ -704,6 +2167,30 @@ class PlanCost(ModelSQL, ModelView):
                     'internal_cost': value,
                     })
 
+    @classmethod
+    def on_modification(cls, mode, costs, field_names=None):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        super().on_modification(mode, costs, field_names=field_names)
+        if (mode == 'delete'
+                or Transaction().context.get('skip_update_costs')
+                or (field_names is not None and not field_names & {
+                        'plan', 'type', 'internal_cost', 'system'})):
+            return
+        Plan.store_costs(list({c.plan for c in costs}))
+
+    @classmethod
+    def on_delete(cls, costs):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        callback = super().on_delete(costs)
+        if not Transaction().context.get('skip_update_costs'):
+            plan_ids = list({c.plan.id for c in costs})
+            callback.append(lambda: Plan.store_costs(Plan.search([
+                            ('id', 'in', plan_ids),
+                            ])))
+        return callback
+
     @classmethod
     def delete(cls, costs):
         Warning = Pool().get('res.user.warning')
@@ -720,11 +2207,350 @@ class PlanCost(ModelSQL, ModelView):
         super(PlanCost, cls).delete(costs)
 
 
+class PlanSnapshot(ModelSQL, ModelView):
+    'Product Cost Plan Snapshot'
+    __name__ = 'product.cost.plan.snapshot'
+
+    plan = fields.Many2One('product.cost.plan', 'Plan', required=True,
+        ondelete='CASCADE', readonly=True)
+    date = fields.DateTime('Date', required=True, readonly=True)
+    product = fields.Many2One('product.product', 'Product', readonly=True)
+    bom = fields.Many2One('production.bom', 'BOM', readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    uom = fields.Many2One('product.uom', 'UoM', readonly=True)
+    products_cost = fields.Numeric('Products Cost', digits=price_digits,
+        readonly=True)
+    cost_price = fields.Numeric('Unit Cost Price', digits=price_digits,
+        readonly=True)
+    lines = fields.Integer('Lines', readonly=True)
+    data = fields.Binary('Data', readonly=True,
+        help='The compressed columns of the breakdown and the costs.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.plan, Index.Range()), (t.date, Index.Range())))
+        cls._order = [
+            ('date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+        cls.__rpc__.update({
+                'diff': RPC(instantiate=0),
+                })
+
+    def get_rec_name(self, name):
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        lang = Lang.get()
+        return '%s @ %s' % (self.plan.rec_name, lang.strftime(self.date))
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        return [('plan.rec_name',) + tuple(clause[1:])]
+
+    @classmethod
+    def check_modification(cls, mode, snapshots, values=None,
+            external=False):
+        super().check_modification(
+            mode, snapshots, values=values, external=external)
+        if mode == 'write':
+            raise AccessError(gettext(
+                    'product_cost_plan.msg_snapshot_immutable'))
+
+    @classmethod
+    def take(cls, plans):
+        "Creates a snapshot of each plan"
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+
+        now = datetime.datetime.now()
+        vlist = []
+        for plan in Plan.browse([p.id for p in plans]):
+            columns = {c: [] for c in SNAPSHOT_COLUMNS}
+            for row in Plan.get_breakdown([plan]):
+                for column in SNAPSHOT_COLUMNS:
+                    columns[column].append(row[column])
+            costs = [{
+                    'type': c.type.rec_name,
+                    'system': c.system,
+                    'cost': c.cost,
+                    } for c in plan.costs]
+            data = json.dumps({
+                    'columns': columns,
+                    'costs': costs,
+                    }, default=str, separators=(',', ':'))
+            vlist.append({
+                    'plan': plan.id,
+                    'date': now,
+                    'product': plan.product.id if plan.product else None,
+                    'bom': plan.bom.id if plan.bom else None,
+                    'quantity': plan.quantity,
+                    'uom': plan.uom.id,
+                    'products_cost': plan.products_cost,
+                    'cost_price': plan.cost_price,
+                    'lines': len(columns['level']),
+                    'data': zlib.compress(data.encode('utf-8')),
+                    })
+        with without_check_access():
+            snapshots = cls.create(vlist)
+            if SNAPSHOT_RETENTION:
+                cls.prune(plans, SNAPSHOT_RETENTION)
+        return snapshots
+
+    @classmethod
+    def prune(cls, plans, retention):
+        "Deletes the snapshots of the plans but the latest retention ones"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        to_delete = []
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            query = table.select(table.id,
+                RowNumber(window=Window([table.plan],
+                        order_by=[table.date.desc, table.id.desc])
+                    ).as_('rank'),
+                where=fields.SQL_OPERATORS['in'](
+                    table.plan, [p.id for p in sub_plans]))
+            cursor.execute(*query.select(query.id,
+                    where=query.rank > retention))
+            to_delete.extend(cls.browse([i for i, in cursor]))
+        if to_delete:
+            cls.delete(to_delete)
+
+    def _load(self):
+        data = json.loads(zlib.decompress(self.data).decode('utf-8'))
+        for column in SNAPSHOT_DECIMAL_COLUMNS:
+            data['columns'][column] = [Decimal(v) if v is not None else None
+                for v in data['columns'][column]]
+        for cost in data['costs']:
+            if cost['cost'] is not None:
+                cost['cost'] = Decimal(cost['cost'])
+        return data
+
+    def get_rows(self):
+        "Returns the breakdown rows of the snapshot like get_breakdown"
+        columns = self._load()['columns']
+        return [dict(zip(SNAPSHOT_COLUMNS, values))
+            for values in zip(*(columns[c] for c in SNAPSHOT_COLUMNS))]
+
+    def get_costs(self):
+        "Returns the type name, system flag and cost of the snapshot costs"
+        return self._load()['costs']
+
+    @classmethod
+    def diff(cls, snapshots):
+        "Returns the differences between two snapshots"
+        if len(snapshots) != 2:
+            raise UserError(gettext(
+                    'product_cost_plan.msg_snapshot_diff_count'))
+        old, new = snapshots
+
+        def values(snapshot):
+            data = snapshot._load()
+            columns = data['columns']
+            products = defaultdict(Decimal)
+            for product, unit_cost in zip(
+                    columns['product'], columns['unit_cost']):
+                products[product] += unit_cost or 0
+            costs = defaultdict(Decimal)
+            for cost in data['costs']:
+                costs[cost['type']] += cost['cost'] or 0
+            return products, costs
+
+        def compare(old_values, new_values):
+            result = []
+            for name in sorted(old_values.keys() | new_values.keys(),
+                    key=lambda n: n or ''):
+                old_value = old_values.get(name, Decimal(0))
+                new_value = new_values.get(name, Decimal(0))
+                if old_value != new_value:
+                    result.append({
+                            'name': name,
+                            'old': old_value,
+                            'new': new_value,
+                            'difference': new_value - old_value,
+                            })
+            return result
+
+        old_products, old_costs = values(old)
+        new_products, new_costs = values(new)
+        return {
+            'totals': compare(
+                {n: getattr(old, n) or 0
+                    for n in ['products_cost', 'cost_price']},
+                {n: getattr(new, n) or 0
+                    for n in ['products_cost', 'cost_price']}),
+            'products': compare(old_products, new_products),
+            'costs': compare(old_costs, new_costs),
+            }
+
+
+class PlanBOMDigest(ModelSQL):
+    'Product Cost Plan BOM Digest'
+    __name__ = 'product.cost.plan.bom_digest'
+
+    plan = fields.Many2One('product.cost.plan', 'Plan', required=True,
+        ondelete='CASCADE', readonly=True)
+    bom = fields.Many2One('production.bom', 'BOM', ondelete='SET NULL',
+        readonly=True)
+    digest = fields.Char('Digest', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.plan, Index.Range())),
+                Index(t, (t.bom, Index.Range())),
+                })
+
+    @classmethod
+    def record(cls, plans):
+        "Stores the digests of the BOMs exploded by the plans"
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        BOM = pool.get('production.bom')
+
+        cls.clear(plans)
+        plan_boms = Plan.get_exploded_boms(plans)
+        boms = BOM.browse(list(set().union(*plan_boms.values())))
+        digests = {b.id: b.cost_plan_digest for b in boms}
+        missing = [b for b in boms if not b.cost_plan_digest]
+        if missing:
+            digests.update(BOM.update_cost_plan_digest(missing))
+        cls.create([{
+                    'plan': plan_id,
+                    'bom': bom_id,
+                    'digest': digests[bom_id],
+                    }
+                for plan_id, bom_ids in plan_boms.items()
+                for bom_id in bom_ids])
+
+    @classmethod
+    def invalidate_products(cls, products):
+        "Makes stale the rolled-up plans using the products"
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        Input = pool.get('production.bom.input')
+        table = cls.__table__()
+        plan = Plan.__table__()
+        input_ = Input.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_products in grouped_slice(
+                products, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.update([table.digest], [None],
+                    where=table.bom.in_(input_.select(input_.bom,
+                            where=fields.SQL_OPERATORS['in'](input_.product,
+                                [p.id for p in sub_products])))
+                    & table.plan.in_(plan.select(plan.id,
+                            where=plan.rolled_up == Literal(True)))))
+
+    @classmethod
+    def clear(cls, plans):
+        "Deletes the digests of the plans, which makes them stale"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.delete(
+                    where=fields.SQL_OPERATORS['in'](
+                        table.plan, [p.id for p in sub_plans])))
+
+
+class PlanWhereUsed(ModelSQL, ModelView):
+    'Product Cost Plan Where Used'
+    __name__ = 'product.cost.plan.where_used'
+
+    product = fields.Many2One('product.product', 'Product', readonly=True)
+    plan = fields.Many2One('product.cost.plan', 'Plan', readonly=True)
+    lines = fields.Integer('Lines', readonly=True)
+    min_cost_price = fields.Numeric('Minimum Cost Price',
+        digits=price_digits, readonly=True)
+    max_cost_price = fields.Numeric('Maximum Cost Price',
+        digits=price_digits, readonly=True)
+    plan_cost_price = fields.Numeric('Plan Unit Cost Price',
+        digits=price_digits, readonly=True)
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        ProductLine = pool.get('product.cost.plan.product_line')
+        Plan = pool.get('product.cost.plan')
+        line = ProductLine.__table__()
+        plan = Plan.__table__()
+        return line.join(plan, condition=line.root_plan == plan.id).select(
+            Min(line.id).as_('id'),
+            line.product.as_('product'),
+            line.root_plan.as_('plan'),
+            Count(line.id).as_('lines'),
+            Min(line.cost_price).as_('min_cost_price'),
+            Max(line.cost_price).as_('max_cost_price'),
+            plan.cost_price.as_('plan_cost_price'),
+            where=line.product != Null,
+            group_by=[line.product, line.root_plan, plan.cost_price])
+
+
 class CreateBomStart(ModelView):
     'Create BOM Start'
     __name__ = 'product.cost.plan.create_bom.start'
 
-    name = fields.Char('Name', required=True)
+    name = fields.Char('Name',
+        states={
+            'required': Eval('plans_count', 0) <= 1,
+            },
+        help="Leave empty to name each BOM after its plan.")
+    plans_count = fields.Integer('Plans Count', readonly=True)
+
+
+class ExportBreakdownStart(ModelView):
+    'Export Cost Plan Breakdown Start'
+    __name__ = 'product.cost.plan.export_breakdown.start'
+
+    format = fields.Selection([
+            ('csv', 'CSV'),
+            ('jsonl', 'JSON Lines'),
+            ], 'Format', required=True)
+
+    @staticmethod
+    def default_format():
+        return 'csv'
+
+
+class ExportBreakdownResult(ModelView):
+    'Export Cost Plan Breakdown Result'
+    __name__ = 'product.cost.plan.export_breakdown.result'
+
+    file = fields.Binary('File', filename='filename', readonly=True)
+    filename = fields.Char('File Name', readonly=True)
+
+
+class ExportBreakdown(Wizard):
+    'Export Cost Plan Breakdown'
+    __name__ = 'product.cost.plan.export_breakdown'
+
+    start = StateView('product.cost.plan.export_breakdown.start',
+        'product_cost_plan.export_breakdown_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', True),
+            ])
+    export = StateView('product.cost.plan.export_breakdown.result',
+        'product_cost_plan.export_breakdown_result_view_form', [
+            Button('Close', 'end', 'tryton-close', True),
+            ])
+
+    def default_export(self, fields):
+        Plan = Pool().get('product.cost.plan')
+        # Rows are written to disk so only the final file is kept in memory
+        with tempfile.TemporaryFile() as file:
+            Plan.write_breakdown(self.records, file, format_=self.start.format)
+            file.seek(0)
+            data = file.read()
+        return {
+            'file': data,
+            'filename': 'cost_plan_breakdown.%s' % self.start.format,
+            }
 
 
 class CreateBom(Wizard):
@@ -739,18 +2565,22 @@ class CreateBom(Wizard):
     bom = StateAction('production.act_bom_list')
 
     def default_start(self, fields):
-        CostPlan = Pool().get('product.cost.plan')
-        plan = CostPlan(Transaction().context.get('active_id'))
-        return {
-            'name': plan.rec_name,
+        values = {
+            'plans_count': len(self.records),
             }
+        if len(self.records) == 1:
+            values['name'] = self.record.rec_name
+        return values
 
     def do_bom(self, action):
         CostPlan = Pool().get('product.cost.plan')
-        plan = CostPlan(Transaction().context.get('active_id'))
-        bom = plan.create_bom(self.start.name)
+        boms = CostPlan.create_boms(self.records, name=self.start.name)
+        if len(boms) == 1:
+            action['views'].reverse()
+        else:
+            action['pyson_domain'] = PYSONEncoder().encode(
+                [('id', 'in', [b.id for b in boms])])
         data = {
-            'res_id': [bom.id]
+            'res_id': [b.id for b in boms],
             }
-        action['views'].reverse()
         return action, data
@@ -0,0 +1,33 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction, without_check_access
+
+__all__ = ['ProductCostPrice']
+
+
+class ProductCostPrice(metaclass=PoolMeta):
+    __name__ = 'product.cost_price'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        ProductLine = pool.get('product.cost.plan.product_line')
+        BOMDigest = pool.get('product.cost.plan.bom_digest')
+        super().on_modification(mode, records, field_names=field_names)
+        if mode == 'delete' or (
+                field_names is not None and 'cost_price' not in field_names):
+            return
+        Plan._sub_assembly_cost_cache.clear()
+        company2products = {}
+        for record in records:
+            if record.product:
+                company2products.setdefault(
+                    record.company.id, set()).add(record.product)
+        for company, products in company2products.items():
+            with Transaction().set_context(company=company), \
+                    without_check_access():
+                ProductLine.update_product_cost_price(list(products))
+        BOMDigest.invalidate_products(
+            list(set().union(*company2products.values())))
@@ -0,0 +1,257 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmark of the product cost plan operations
+
+Generates a synthetic BOM tree of the given depth and fan-out and reports the
+time, the number of SQL queries and the peak memory of each operation of the
+cost plan. It runs on an in-memory SQLite database unless TRYTOND_DATABASE_URI
+and DB_NAME are set:
+
+    python -m trytond.modules.product_cost_plan.tests.benchmark \\
+        --depth 3 --fanout 4 --uoms u,kg,m --format json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond import backend  # noqa: E402
+from trytond.modules.product_cost_plan import instrumentation  # noqa: E402
+from trytond.pool import Pool  # noqa: E402
+from trytond.tests.test_tryton import (  # noqa: E402
+    CONTEXT, DB_NAME, USER, activate_module)
+from trytond.transaction import Transaction  # noqa: E402
+
+# Unit of the inputs for each unit of the products
+INPUT_UOMS = {
+    'u': 'u',
+    'kg': 'g',
+    'g': 'kg',
+    'm': 'cm',
+    'cm': 'm',
+    'l': 'cm³',
+    }
+
+
+@contextmanager
+def transaction(commit=False):
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        User = Pool().get('res.user')
+        with transaction.set_context(
+                User.get_preferences(context_only=True)):
+            yield transaction
+        if not commit:
+            transaction.rollback()
+
+
+def measure(operation, function, repeat=1, commit=False):
+    "Returns the metrics of running function in a new transaction"
+    durations, queries, memory = [], [], []
+    for i in range(repeat):
+        with transaction(commit=commit and i == repeat - 1) as transaction_, \
+                transaction_.set_context(cost_plan_instrumentation=True):
+            with instrumentation.measure(operation):
+                tracemalloc.start()
+                start = time.perf_counter()
+                records = function()
+                durations.append(time.perf_counter() - start)
+                memory.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            queries.append(
+                instrumentation.get_statistics()[operation]['queries'])
+    return {
+        'operation': operation,
+        'repeat': repeat,
+        'seconds': min(durations),
+        'median_seconds': statistics.median(durations),
+        'queries': queries[-1],
+        'peak_memory': max(memory),
+        'records': records,
+        }
+
+
+def create_data(depth, fanout, uoms):
+    "Creates a BOM tree and returns the id of its plan"
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    BOM = pool.get('production.bom')
+    ProductBOM = pool.get('product.product-production.bom')
+    Plan = pool.get('product.cost.plan')
+
+    symbol2uom = {u.symbol: u for u in Uom.search([
+                ('symbol', 'in', list(uoms) + [INPUT_UOMS[u] for u in uoms]),
+                ])}
+    products = []
+
+    def create_level(level):
+        uoms_ = [symbol2uom[uoms[(len(products) + i) % len(uoms)]]
+            for i in range(fanout ** level)]
+        templates = Template.create([{
+                    'name': 'Product %s.%s' % (level, i),
+                    'type': 'goods',
+                    'producible': level < depth,
+                    'default_uom': uom.id,
+                    'list_price': Decimal(1),
+                    'products': [('create', [{
+                                    'cost_price': Decimal(i % 7 + 1),
+                                    }])],
+                    } for i, uom in enumerate(uoms_)])
+        level_products = [t.products[0] for t in templates]
+        products.extend(level_products)
+        return level_products
+
+    parents = create_level(0)
+    root = parents[0]
+    root_bom = None
+    for level in range(1, depth + 1):
+        children = create_level(level)
+        boms = BOM.create([{
+                    'name': parent.rec_name,
+                    'inputs': [('create', [{
+                                    'product': child.id,
+                                    'quantity': 2,
+                                    'unit': symbol2uom[
+                                        INPUT_UOMS[child.default_uom.symbol]
+                                        ].id,
+                                    } for child in children[
+                                    i * fanout:(i + 1) * fanout]])],
+                    'outputs': [('create', [{
+                                    'product': parent.id,
+                                    'quantity': 1,
+                                    'unit': parent.default_uom.id,
+                                    }])],
+                    } for i, parent in enumerate(parents)])
+        ProductBOM.create([{
+                    'product': parent.id,
+                    'bom': bom.id,
+                    } for parent, bom in zip(parents, boms)])
+        root_bom = root_bom or boms[0]
+        parents = children
+
+    # Explode all the sub-assemblies
+    plan, = Plan.create([{
+                'name': 'Benchmark',
+                'product': root.id,
+                'bom': root_bom.id if root_bom else None,
+                'quantity': 1,
+                'uom': root.default_uom.id,
+                'boms': [('create', [{
+                                'product': product_id,
+                                'bom': bom_id,
+                                } for product_id, bom_id in Plan(
+                                bom=root_bom).find_boms()])],
+                }])
+    return plan.id
+
+
+def run(depth, fanout, uoms, repeat=1):
+    from trytond.modules.company.tests import create_company
+
+    with transaction(commit=True):
+        User = Pool().get('res.user')
+        company = create_company()
+        User.write([User(USER)], {
+                'companies': [('add', [company.id])],
+                'company': company.id,
+                })
+    with transaction(commit=True):
+        plan_id = create_data(depth, fanout, uoms)
+
+    def find_boms():
+        Plan = Pool().get('product.cost.plan')
+        Plan._find_boms_cache.clear()
+        return len(Plan(plan_id).find_boms())
+
+    def find_boms_cached():
+        Plan = Pool().get('product.cost.plan')
+        return len(Plan(plan_id).find_boms())
+
+    def compute():
+        Plan = Pool().get('product.cost.plan')
+        plan = Plan(plan_id)
+        Plan.compute([plan])
+        return len(plan.all_products)
+
+    def get_products_cost():
+        Plan = Pool().get('product.cost.plan')
+        plans = Plan.browse([plan_id])
+        for plan in plans:
+            plan.get_products_cost('products_cost')
+        return len(plans)
+
+    def create_bom():
+        Plan = Pool().get('product.cost.plan')
+        plan = Plan(plan_id)
+        with Transaction().set_context(_skip_warnings=True):
+            bom = plan.create_bom('Benchmark')
+        return len(bom.inputs)
+
+    results = [measure('find_boms', find_boms, repeat)]
+    # The cache is only shared with the other transactions once committed
+    with transaction(commit=True):
+        find_boms_cached()
+    results += [
+        measure('find_boms_cached', find_boms_cached, repeat),
+        measure('compute', compute, repeat, commit=True),
+        measure('get_products_cost', get_products_cost, repeat),
+        measure('create_bom', create_bom, repeat),
+        ]
+    return {
+        'depth': depth,
+        'fanout': fanout,
+        'uoms': list(uoms),
+        'backend': backend.name,
+        'results': results,
+        }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the product cost plan operations")
+    parser.add_argument('--depth', type=int, default=3,
+        help="levels of sub-assemblies")
+    parser.add_argument('--fanout', type=int, default=4,
+        help="inputs per BOM")
+    parser.add_argument('--uoms', default='u',
+        help="comma separated symbols of the product units, the inputs use "
+        "another unit of the same category (%s)" % ', '.join(INPUT_UOMS))
+    parser.add_argument('--repeat', type=int, default=1,
+        help="runs of each operation, the fastest is reported")
+    parser.add_argument('--format', choices=['text', 'json'],
+        default='text')
+    arguments = parser.parse_args(arguments)
+    uoms = arguments.uoms.split(',')
+    for uom in uoms:
+        if uom not in INPUT_UOMS:
+            parser.error("unknown unit %r" % uom)
+
+    activate_module('product_cost_plan')
+    report = run(arguments.depth, arguments.fanout, uoms,
+        repeat=arguments.repeat)
+
+    if arguments.format == 'json':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print("depth %(depth)s, fanout %(fanout)s, uoms %(uoms)s" % report)
+        print('%-20s %10s %8s %12s %8s' % (
+                'operation', 'seconds', 'queries', 'peak memory', 'records'))
+        for result in report['results']:
+            print('%-20s %10.4f %8s %12d %8d' % (
+                    result['operation'], result['seconds'],
+                    result['queries'], result['peak_memory'],
+                    result['records']))
+
+
+if __name__ == '__main__':
+    main()
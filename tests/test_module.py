@@ -1,14 +1,717 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
+import datetime
+import io
+import json
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.exceptions import UserError
+from trytond.model.exceptions import ValidationError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.product_cost_plan import plan as plan_module
+from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONEncoder
+from trytond.tests.test_tryton import (DB_NAME, ModuleTestCase,
+    activate_module, drop_db, with_transaction)
+from trytond.transaction import Transaction
 
 
 class ProductCostPlanTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProductCostPlan module'
     module = 'product_cost_plan'
 
+    @with_transaction()
+    def test_create_bom_start_view(self):
+        'Test the create BOM start view can be sent to the clients'
+        pool = Pool()
+        CreateBomStart = pool.get('product.cost.plan.create_bom.start')
+
+        view = CreateBomStart.fields_view_get()
+        json.dumps(view, cls=JSONEncoder)
+        self.assertEqual(view['fields']['name']['required'], False)
+
+    @with_transaction()
+    def test_product_line_root_plan(self):
+        'Test the root plan of the product lines'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        ProductLine = pool.get('product.cost.plan.product_line')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            plan1, plan2 = Plan.create([{
+                        'name': name,
+                        'quantity': 1,
+                        'uom': unit.id,
+                        } for name in ['Plan 1', 'Plan 2']])
+            root1, root2 = ProductLine.create([{
+                        'name': 'Root %s' % plan.id,
+                        'plan': plan.id,
+                        'quantity': 1,
+                        'uom': unit.id,
+                        'cost_price': 0,
+                        'children': [('create', [{
+                                        'name': 'Child',
+                                        'quantity': 2,
+                                        'uom': unit.id,
+                                        'cost_price': 0,
+                                        'children': [('create', [{
+                                                        'name': 'Grandchild',
+                                                        'quantity': 3,
+                                                        'uom': unit.id,
+                                                        'cost_price': 0,
+                                                        }])],
+                                        }])],
+                        } for plan in [plan1, plan2]])
+
+            self.assertEqual(
+                ProductLine.search([('root_plan', '=', plan1.id)]),
+                ProductLine.search([('parent', 'child_of', [root1.id])]))
+
+            child, = root1.children
+            ProductLine.write([child], {'parent': root2.id})
+            self.assertEqual(
+                ProductLine.search([('root_plan', '=', plan1.id)]), [root1])
+            self.assertEqual(
+                len(ProductLine.search([('root_plan', '=', plan2.id)])), 5)
+
+            def depth_first(lines):
+                for line in lines:
+                    yield line
+                    yield from depth_first(line.children)
+            plan2 = Plan(plan2.id)
+            self.assertEqual(
+                list(plan2.all_products), list(depth_first(plan2.products)))
+
+    @with_transaction()
+    def test_find_boms(self):
+        'Test the sub-assemblies found from the BOM of the plans'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        BOM = pool.get('production.bom')
+        Input = pool.get('production.bom.input')
+        ProductBOM = pool.get('product.product-production.bom')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            templates = Template.create([{
+                        'name': name,
+                        'type': 'goods',
+                        'producible': True,
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        } for name in ['P', 'A', 'B', 'C', 'S', 'D', 'E']])
+            p, a, b, c, s, d, e = [t.products[0] for t in templates]
+
+            def create_bom(output, inputs):
+                bom, = BOM.create([{
+                            'name': output.rec_name,
+                            'inputs': [('create', [{
+                                            'product': i.id,
+                                            'quantity': 1,
+                                            'unit': unit.id,
+                                            } for i in inputs])],
+                            'outputs': [('create', [{
+                                            'product': output.id,
+                                            'quantity': 1,
+                                            'unit': unit.id,
+                                            }])],
+                            }])
+                ProductBOM.create([{
+                            'product': output.id,
+                            'bom': bom.id,
+                            }])
+                return bom
+
+            # A and B share the sub-assembly S
+            bom_d = create_bom(d, [c])
+            bom_s = create_bom(s, [d])
+            bom_a = create_bom(a, [c, s])
+            bom_b = create_bom(b, [s])
+            bom_p = create_bom(p, [a, b])
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'product': p.id,
+                        'bom': bom_p.id,
+                        'quantity': 1,
+                        'uom': unit.id,
+                        }])
+            boms = sorted([
+                    (a.id, bom_a.id),
+                    (b.id, bom_b.id),
+                    (s.id, bom_s.id),
+                    (d.id, bom_d.id),
+                    ])
+            self.assertEqual(sorted(plan.find_boms()), boms)
+
+            bom_e = create_bom(e, [])
+            Input.create([{
+                        'bom': bom_b.id,
+                        'product': e.id,
+                        'quantity': 1,
+                        'unit': unit.id,
+                        }])
+            self.assertIn((e.id, bom_e.id), plan.find_boms())
+            ProductBOM.delete(ProductBOM.search([('product', '=', e.id)]))
+            self.assertEqual(sorted(plan.find_boms()), boms)
+
+            for records, values in [
+                    (BOM.browse([bom_d]), {'name': 'D'}),
+                    (bom_d.inputs, {'quantity': 2}),
+                    (ProductBOM.search([('bom', '=', bom_d.id)]),
+                        {'sequence': 20}),
+                    ]:
+                plan.find_boms()
+                self.assertIsNotNone(Plan._find_boms_cache.get(bom_p.id))
+                records[0].__class__.write(list(records), values)
+                self.assertIsNone(Plan._find_boms_cache.get(bom_p.id))
+
+            # D uses A back, which the BOMs do not allow to create
+            input_table = Input.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*input_table.update(
+                    [input_table.product], [a.id],
+                    where=input_table.bom == bom_d.id))
+            Transaction().cache.clear()
+            Plan._find_boms_cache.clear()
+            self.assertEqual(sorted(plan.find_boms()), boms)
+
+    @with_transaction()
+    def test_product_line_move_costs(self):
+        'Test the stored costs of the plans when moving product lines'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        ProductLine = pool.get('product.cost.plan.product_line')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            plan1, plan2 = Plan.create([{
+                        'name': name,
+                        'quantity': 1,
+                        'uom': unit.id,
+                        } for name in ['Plan 1', 'Plan 2']])
+            root1, root2 = ProductLine.create([{
+                        'name': 'Root %s' % plan.id,
+                        'plan': plan.id,
+                        'quantity': 1,
+                        'uom': unit.id,
+                        'cost_price': Decimal(1),
+                        'children': [('create', [{
+                                        'name': 'Child',
+                                        'quantity': 2,
+                                        'uom': unit.id,
+                                        'cost_price': Decimal(5),
+                                        }])],
+                        } for plan in [plan1, plan2]])
+            self.assertEqual(
+                [p.products_cost for p in Plan.browse([plan1, plan2])],
+                [Decimal(11), Decimal(11)])
+
+            child, = root1.children
+            self.assertEqual(
+                child.get_unit_cost('unit_cost'), child.unit_cost)
+            self.assertEqual(
+                child.get_total_cost('total_cost'), child.total_cost)
+            ProductLine.write([child], {'parent': root2.id})
+            self.assertEqual(
+                [p.products_cost for p in Plan.browse([plan1, plan2])],
+                [Decimal(1), Decimal(21)])
+
+            ProductLine.write([root1], {'plan': plan2.id})
+            self.assertEqual(
+                [p.products_cost for p in Plan.browse([plan1, plan2])],
+                [Decimal(0), Decimal(22)])
+
+    @with_transaction(context={'_skip_warnings': True})
+    def test_clean_product_lines(self):
+        'Test the clean of the plans deletes the notes of the lines'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        ProductLine = pool.get('product.cost.plan.product_line')
+        Note = pool.get('ir.note')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'quantity': 1,
+                        'uom': unit.id,
+                        'products': [('create', [{
+                                        'name': 'Root',
+                                        'quantity': 1,
+                                        'uom': unit.id,
+                                        'cost_price': Decimal(1),
+                                        }])],
+                        }])
+            line, = plan.products
+            note, = Note.create([{
+                        'resource': str(line),
+                        'message': 'Note',
+                        }])
+            self.assertEqual(line.name, 'Root')
+
+            Plan.clean([plan])
+            self.assertEqual(ProductLine.search([('id', '=', line.id)]), [])
+            self.assertEqual(Note.search([('id', '=', note.id)]), [])
+            self.assertEqual(Plan(plan.id).products, ())
+
+    @with_transaction()
+    def test_export_breakdown(self):
+        'Test the export of the breakdown of the plans'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        ExportBreakdown = pool.get(
+            'product.cost.plan.export_breakdown', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            leaf = {
+                'name': 'Leaf',
+                'quantity': 3,
+                'uom': unit.id,
+                'cost_price': Decimal('0.5'),
+                }
+            child = {
+                'name': 'Child',
+                'quantity': 2,
+                'uom': unit.id,
+                'cost_price': Decimal(5),
+                'children': [('create', [leaf])],
+                }
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'quantity': 2,
+                        'uom': unit.id,
+                        'products': [('create', [{
+                                        'name': 'Root',
+                                        'quantity': 1,
+                                        'uom': unit.id,
+                                        'cost_price': Decimal(1),
+                                        'children': [('create', [child])],
+                                        }])],
+                        }])
+
+            session_id, _, _ = ExportBreakdown.create()
+            with Transaction().set_context(
+                    active_model=Plan.__name__, active_id=plan.id,
+                    active_ids=[plan.id]):
+                export = ExportBreakdown(session_id)
+                export.start.format = 'csv'
+                result = export.default_export(None)
+            self.assertEqual(result['filename'], 'cost_plan_breakdown.csv')
+            rows = list(csv.DictReader(
+                    io.StringIO(result['file'].decode('utf-8'))))
+            self.assertEqual(
+                [(r['level'], r['name'], r['total_cost']) for r in rows], [
+                    ('0', 'Root', '1.0000'),
+                    ('1', '  Child', '10.0000'),
+                    ('2', '    Leaf', '3.0000'),
+                    ])
+
+            with Transaction().set_context(
+                    active_model=Plan.__name__, active_id=plan.id,
+                    active_ids=[plan.id]):
+                export = ExportBreakdown(session_id)
+                export.start.format = 'jsonl'
+                result = export.default_export(None)
+            rows = [json.loads(l)
+                for l in result['file'].decode('utf-8').splitlines()]
+            self.assertEqual(
+                [(r['level'], r['name'], r['unit_cost']) for r in rows], [
+                    (0, 'Root', '0.5000'),
+                    (1, 'Child', '5.0000'),
+                    (2, 'Leaf', '1.5000'),
+                    ])
+
+    @with_transaction()
+    def test_fill_stored_costs(self):
+        'Test the migration of the stored costs of the plans'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        CostType = pool.get('product.cost.plan.cost.type')
+        table = Plan.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            system_type, = CostType.search([('system', '=', True)])
+            cost_type, = CostType.create([{
+                        'name': 'Labour',
+                        }])
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'quantity': 2,
+                        'uom': unit.id,
+                        'products': [('create', [{
+                                        'name': 'Root',
+                                        'quantity': 1,
+                                        'uom': unit.id,
+                                        'cost_price': Decimal(3),
+                                        'children': [('create', [{
+                                                        'name': 'Child',
+                                                        'quantity': 2,
+                                                        'uom': unit.id,
+                                                        'cost_price': (
+                                                            Decimal('1.5')),
+                                                        }])],
+                                        }])],
+                        'costs': [('create', [{
+                                        'type': system_type.id,
+                                        'system': True,
+                                        }, {
+                                        'type': cost_type.id,
+                                        'cost': Decimal(10),
+                                        }])],
+                        }])
+            Plan.update_costs([plan])
+            products_cost, cost_price = plan.products_cost, plan.cost_price
+            self.assertEqual(products_cost, Decimal('3.0000'))
+            self.assertEqual(cost_price, Decimal('13.0000'))
+
+            cursor.execute(*table.update(
+                    [table.products_cost, table.cost_price], [None, None]))
+            Plan._fill_stored_costs()
+            cursor.execute(*table.select(
+                    table.products_cost, table.cost_price,
+                    where=table.id == plan.id))
+            self.assertEqual(cursor.fetchone(), (products_cost, cost_price))
+
+    @with_transaction()
+    def test_compute_pending_timeout(self):
+        'Test a lost compute is no more pending after the timeout'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        table = Plan.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'quantity': 1,
+                        'uom': unit.id,
+                        }])
+            Plan.write([plan], {'compute_state': 'running'})
+            self.assertTrue(Plan(plan.id).compute_pending)
+            self.assertEqual(
+                Plan.search([('compute_pending', '=', True)]), [plan])
+            with self.assertRaises(UserError):
+                Plan.check_compute_state([Plan(plan.id)])
+
+            cursor.execute(*table.update([table.write_date],
+                    [datetime.datetime.now() - datetime.timedelta(days=1)]))
+            Transaction().cache.clear()
+            self.assertFalse(Plan(plan.id).compute_pending)
+            self.assertEqual(
+                Plan.search([('compute_pending', '=', False)]), [plan])
+            Plan.check_compute_state([Plan(plan.id)])
+
+            for clause, result in [
+                    (('compute_pending', 'in', [False]), [plan]),
+                    (('compute_pending', 'in', [True, False]), [plan]),
+                    (('compute_pending', 'in', []), []),
+                    (('compute_pending', 'not in', [False]), []),
+                    (('compute_pending', 'like', 'True'), []),
+                    ]:
+                self.assertEqual(Plan.search([clause]), result, clause)
+
+    @with_transaction()
+    def test_search_stale(self):
+        'Test the search of the stale plans'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'quantity': 1,
+                        'uom': unit.id,
+                        }])
+            for clause, result in [
+                    (('stale', '=', True), []),
+                    (('stale', '=', False), [plan]),
+                    (('stale', '!=', True), [plan]),
+                    (('stale', 'in', [True]), []),
+                    (('stale', 'in', [True, False]), [plan]),
+                    (('stale', 'in', []), []),
+                    (('stale', 'not in', [True]), [plan]),
+                    (('stale', 'not in', [True, False]), []),
+                    (('stale', 'like', 'True'), []),
+                    ]:
+                self.assertEqual(Plan.search([clause]), result, clause)
+
+    @with_transaction()
+    def test_product_line_bulk_create(self):
+        'Test the bulk create of the product lines'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        CostType = pool.get('product.cost.plan.cost.type')
+        ProductLine = pool.get('product.cost.plan.product_line')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            system_type, = CostType.search([('system', '=', True)])
+            plan, = Plan.create([{
+                        'name': 'Plan',
+                        'quantity': 2,
+                        'uom': unit.id,
+                        'costs': [('create', [{
+                                        'type': system_type.id,
+                                        'system': True,
+                                        }])],
+                        }])
+
+            ids = ProductLine.bulk_create([{
+                        'name': 'Line %s' % i,
+                        'plan': plan.id,
+                        'quantity': i,
+                        'uom': unit.id,
+                        'cost_price': Decimal(3),
+                        } for i in range(1, 4)])
+
+            lines = ProductLine.browse(ids)
+            self.assertEqual(len(lines), 3)
+            for line in lines:
+                self.assertEqual(line.path, '%s/' % line.id)
+                self.assertEqual(line.root_plan, plan)
+                self.assertEqual(line.parent, None)
+                self.assertEqual(line.party_stock, False)
+                self.assertEqual(line.create_uid.id, transaction.user)
+                self.assertTrue(line.create_date)
+            self.assertEqual(
+                [l.total_cost for l in lines],
+                [Decimal(3), Decimal(6), Decimal(9)])
+            plan = Plan(plan.id)
+            self.assertEqual(plan.products_cost, Decimal('9.0000'))
+            self.assertEqual(plan.cost_price, Decimal('9.0000'))
+
+            with self.assertRaises(ValidationError):
+                ProductLine.bulk_create([{
+                            'name': 'Child',
+                            'plan': plan.id,
+                            'parent': lines[0].id,
+                            'quantity': 1,
+                            'uom': unit.id,
+                            'cost_price': Decimal(0),
+                            }])
+
+    @with_transaction()
+    def test_snapshot_prune(self):
+        'Test the snapshots of the plans are pruned'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Plan = pool.get('product.cost.plan')
+        Snapshot = pool.get('product.cost.plan.snapshot')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('symbol', '=', 'u')])
+            plan1, plan2 = Plan.create([{
+                        'name': name,
+                        'quantity': 1,
+                        'uom': unit.id,
+                        } for name in ['Plan 1', 'Plan 2']])
+            snapshots = [Snapshot.take([plan1, plan2]) for _ in range(3)]
+
+            Snapshot.prune([plan1], 2)
+            self.assertEqual(
+                Snapshot.search([('plan', '=', plan1.id)]),
+                [snapshots[2][0], snapshots[1][0]])
+            self.assertEqual(
+                len(Snapshot.search([('plan', '=', plan2.id)])), 3)
+
+            snapshot = snapshots[2][0]
+            self.assertTrue(
+                snapshot.rec_name.startswith(plan1.rec_name + ' @ '))
+            self.assertEqual(
+                Snapshot.search([('rec_name', '=', plan1.rec_name)]),
+                [snapshots[2][0], snapshots[1][0]])
+            with self.assertRaises(UserError):
+                Snapshot.diff([snapshot])
+
+
+class ProductCostPlanComputeTestCase(unittest.TestCase):
+    'Test the compute of ProductCostPlan in its own transactions'
+
+    @classmethod
+    def setUpClass(cls):
+        drop_db()
+        activate_module('product_cost_plan')
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        drop_db()
+
+    @property
+    def workers(self):
+        # The threads of the workers can not share an in-memory database
+        if DB_NAME == ':memory:':
+            return [1]
+        return [1, 2]
+
+    def create_plans(self, count):
+        'Creates count plans of a product with a BOM'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        BOM = pool.get('production.bom')
+        ProductBOM = pool.get('product.product-production.bom')
+        Plan = pool.get('product.cost.plan')
+
+        unit, = Uom.search([('symbol', '=', 'u')])
+        product, component = [t.products[0] for t in Template.create([{
+                        'name': name,
+                        'type': 'goods',
+                        'producible': True,
+                        'default_uom': unit.id,
+                        'list_price': Decimal(10),
+                        'products': [('create', [{}])],
+                        } for name in ['Product', 'Component']])]
+        Product.write([component], {'cost_price': Decimal(2)})
+        bom, = BOM.create([{
+                    'name': 'Product',
+                    'inputs': [('create', [{
+                                    'product': component.id,
+                                    'quantity': 3,
+                                    'unit': unit.id,
+                                    }])],
+                    'outputs': [('create', [{
+                                    'product': product.id,
+                                    'quantity': 1,
+                                    'unit': unit.id,
+                                    }])],
+                    }])
+        ProductBOM.create([{
+                    'product': product.id,
+                    'bom': bom.id,
+                    }])
+        return Plan.create([{
+                    'name': 'Plan %s' % i,
+                    'product': product.id,
+                    'bom': bom.id,
+                    'quantity': 1,
+                    'uom': unit.id,
+                    } for i in range(count)])
+
+    @with_transaction(context={'_skip_warnings': True})
+    def test_compute_batch_failure(self):
+        'Test a failing chunk is rolled back without stopping the others'
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            plan1, plan2 = self.create_plans(2)
+            # The chunks are computed in their own transactions
+            transaction.commit()
+            Plan.compute_batch([plan1, plan2])
+            transaction.cache.clear()
+            plan1_lines = sorted(l.id for l in Plan(plan1.id).products)
+
+            compute = Plan._compute.__func__
+
+            def fail_compute(cls, plans):
+                compute(cls, plans)
+                if plan1.id in [p.id for p in plans]:
+                    raise ValueError("Compute failure")
+
+            for workers in self.workers:
+                with patch.object(
+                        Plan, '_compute', classmethod(fail_compute)):
+                    results = Plan.compute_batch(
+                        [plan1, plan2], chunk_size=1, workers=workers)
+                self.assertEqual(
+                    [(r['plans'], r['error']) for r in results],
+                    [([plan1.id], "Compute failure"), ([plan2.id], None)])
+                transaction.cache.clear()
+                computed1, computed2 = Plan.browse([plan1.id, plan2.id])
+                self.assertEqual(computed1.compute_state, 'failed')
+                self.assertEqual(
+                    sorted(l.id for l in computed1.products), plan1_lines)
+                self.assertEqual(computed2.compute_state, 'done')
+                self.assertEqual(len(computed2.products), 1)
+                self.assertFalse(computed2.stale)
+
+    @with_transaction(context={'_skip_warnings': True})
+    def test_compute_queued_progress(self):
+        'Test the progress is only written on the plans of pending chunks'
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            plans = self.create_plans(3)
+
+            compute = Plan._compute.__func__
+            write_compute_state = Plan._write_compute_state.__func__
+            events = []
+
+            def record_compute(cls, plans):
+                events.append(('compute', {p.id for p in plans}))
+                compute(cls, plans)
+
+            def record_write(cls, plans, values, only_running=False):
+                if values.get('compute_progress'):
+                    events.append(('progress', {p.id for p in plans}))
+                write_compute_state(
+                    cls, plans, values, only_running=only_running)
+
+            for workers in self.workers:
+                del events[:]
+                Plan.write(plans, {'compute_state': 'queued'})
+                # The chunks are computed in their own transactions
+                transaction.commit()
+                with patch.object(
+                        Plan, '_compute', classmethod(record_compute)), \
+                        patch.object(Plan, '_write_compute_state',
+                            classmethod(record_write)), \
+                        patch.object(plan_module, 'COMPUTE_CHUNK_SIZE', 1), \
+                        patch.object(plan_module, 'COMPUTE_WORKERS', workers):
+                    Plan.compute_queued(Plan.browse(plans))
+
+                started = set()
+                for event, ids in events:
+                    if event == 'compute':
+                        started |= ids
+                    else:
+                        self.assertFalse(ids & started)
+                self.assertEqual(started, {p.id for p in plans})
+                self.assertIn('progress', [e for e, _ in events])
+                transaction.cache.clear()
+                for plan in Plan.browse(plans):
+                    self.assertEqual(plan.compute_state, 'done')
+                    self.assertEqual(plan.compute_progress, 100)
+
 
 del ModuleTestCase
@@ -1,3 +1,4 @@
+import json
 import unittest
 from decimal import Decimal
 
@@ -271,3 +272,254 @@ class Test(unittest.TestCase):
         self.assertEqual(len(plan3.bom.outputs), 1)
         self.assertEqual(plan3.bom.outputs[0].product, product3)
         self.assertEqual(plan3.bom.outputs[0].quantity, 2.0)
+
+        # Update a component cost price and check plan lines are updated
+        component2.cost_price = Decimal(6)
+        component2.save()
+        c2.reload()
+        self.assertEqual(c2.product_cost_price, Decimal('0.0600'))
+        self.assertEqual(c2.cost_price, Decimal('0.0600'))
+        plan.reload()
+        self.assertEqual(plan.cost_price, Decimal('44.0000'))
+        product_line2.reload()
+        self.assertEqual(product_line2.product_cost_price, Decimal('0.0600'))
+        self.assertEqual(product_line2.cost_price, Decimal('0.0450'))
+
+        # Delete a plan with child lines
+        ProductLine = Model.get('product.cost.plan.product_line')
+        plan3.delete()
+        self.assertEqual(ProductLine.find([('parent', '!=', None)]), [])
+
+        # Compute a plan with a rolled-up sub-assembly
+        componentA.cost_price = Decimal(3)
+        componentA.save()
+        plan4 = CostPlan()
+        plan4.product = product
+        plan4.quantity = 1
+        plan4.rolled_up = True
+        plan4.save()
+        PlanBOM = Model.get('product.cost.plan.bom_line')
+        bom_line, = PlanBOM.find([('plan', '=', plan4.id)])
+        self.assertEqual(bom_line.product, component1)
+        bom_line.bom = component_bom
+        bom_line.save()
+        plan4.click('compute')
+        plan4.reload()
+        self.assertEqual(len(plan4.products), 2)
+        c1, = [l for l in plan4.products if l.product == component1]
+        self.assertEqual(c1.quantity, 5.0)
+        self.assertEqual(c1.product_cost_price, Decimal('2.0000'))
+        self.assertEqual(c1.cost_price, Decimal('4.0000'))
+        self.assertEqual(plan4.cost_price, Decimal('29.0000'))
+
+        # Export the breakdown of the plan
+        export = Wizard('product.cost.plan.export_breakdown', [plan4])
+        export.form.format = 'csv'
+        export.execute('export')
+        self.assertEqual(export.form.filename, 'cost_plan_breakdown.csv')
+        rows = export.form.file.decode('utf-8').splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[0].startswith('plan,line,level,name,product'))
+        export = Wizard('product.cost.plan.export_breakdown', [plan4])
+        export.form.format = 'jsonl'
+        export.execute('export')
+        rows = [json.loads(l)
+            for l in export.form.file.decode('utf-8').splitlines()]
+        self.assertEqual(
+            sorted((r['product'], r['total_cost']) for r in rows),
+            [('component 1', '20.0000'), ('component 2', '9.0000')])
+
+        # Simulate the cost of a product without creating a plan
+        n_plans = len(CostPlan.find([]))
+        n_lines = len(ProductLine.find([]))
+        result = CostPlan.simulate(
+            product.id, 2, None, None, {}, False, config.context)
+        self.assertEqual(result['bom'], bom.id)
+        self.assertEqual(len(result['lines']), 2)
+        self.assertEqual(result['products_cost'], Decimal('19.0000'))
+        self.assertEqual(result['cost_price'], Decimal('19.0000'))
+        result = CostPlan.simulate(product.id, 1, None, None,
+            {str(component1.id): component_bom.id}, False, config.context)
+        self.assertEqual(
+            sorted((l['name'], l['total_cost']) for l in result['lines']),
+            [('component 2', Decimal('9.0000')),
+                ('component A', Decimal('15.0000')),
+                ('component B', Decimal('5.0000'))])
+        self.assertEqual(result['cost_price'], Decimal('29.0000'))
+        self.assertEqual(len(CostPlan.find([])), n_plans)
+        self.assertEqual(len(ProductLine.find([])), n_lines)
+
+        # Price curve of the plan for several quantities
+        result, = CostPlan.price_curve(
+            [plan4.id], [1, 0.5, 10], config.context)
+        self.assertEqual(result['plan'], plan4.id)
+        self.assertEqual(
+            [(p['quantity'], p['cost_price']) for p in result['curve']],
+            [(1, plan4.cost_price), (0.5, Decimal('29.0000')),
+                (10, Decimal('29.0000'))])
+
+        # The price curve follows the rounding of the input quantities
+        template = ProductTemplate()
+        template.name = 'curve product'
+        template.producible = True
+        template.default_uom = unit
+        template.type = 'goods'
+        template.list_price = Decimal(10)
+        template.save()
+        curve_product, = template.products
+        curve_bom = BOM(name='curve product')
+        curve_input = curve_bom.inputs.new()
+        curve_input.product = componentA
+        curve_input.quantity = 1
+        curve_input = curve_bom.inputs.new()
+        curve_input.product = component2
+        curve_input.quantity = 1
+        curve_input.unit = centimeter
+        curve_output = curve_bom.outputs.new()
+        curve_output.product = curve_product
+        curve_output.quantity = 3
+        curve_bom.save()
+        curve_product.boms.append(ProductBom(bom=curve_bom))
+        curve_product.save()
+        curve_plan = CostPlan()
+        curve_plan.product = curve_product
+        curve_plan.quantity = 1
+        curve_plan.save()
+        quantities = [1, 2, 3, 4, 100]
+        result, = CostPlan.price_curve(
+            [curve_plan.id], quantities, config.context)
+        curve = [p['cost_price'] for p in result['curve']]
+        self.assertEqual(curve, [Decimal('1.0404'), Decimal('1.0251'),
+                Decimal('1.0200'), Decimal('1.0251'), Decimal('1.0202')])
+        config.skip_warning = True
+        for quantity, cost_price in zip(quantities, curve):
+            curve_plan.quantity = quantity
+            curve_plan.save()
+            curve_plan.click('compute')
+            curve_plan.reload()
+            self.assertEqual(curve_plan.cost_price, cost_price)
+        config.skip_warning = False
+        curve_plan.delete()
+
+        # Compute the plan on the task queue
+        self.assertEqual(plan4.compute_state, 'done')
+        config.skip_warning = True
+        with config.set_context(queue_cost_plan_compute=True):
+            queued_plan = CostPlan(plan4.id)
+            queued_plan.click('compute')
+        config.skip_warning = False
+        queued_plan.reload()
+        self.assertEqual(queued_plan.compute_state, 'done')
+        self.assertEqual(queued_plan.compute_progress, 100)
+        self.assertEqual(len(queued_plan.products), 2)
+        self.assertEqual(queued_plan.cost_price, Decimal('29.0000'))
+
+        # The computes take a snapshot of the plan on demand
+        Snapshot = Model.get('product.cost.plan.snapshot')
+        self.assertEqual(Snapshot.find([('plan', '=', plan4.id)]), [])
+        config.skip_warning = True
+        with config.set_context(cost_plan_snapshot=True):
+            CostPlan(plan4.id).click('compute')
+        config.skip_warning = False
+        snapshot, = Snapshot.find([('plan', '=', plan4.id)])
+        self.assertEqual(snapshot.cost_price, Decimal('29.0000'))
+        self.assertEqual(snapshot.lines, 2)
+        component2.cost_price = Decimal(8)
+        component2.save()
+        config.skip_warning = True
+        with config.set_context(cost_plan_snapshot=True):
+            CostPlan(plan4.id).click('compute')
+        config.skip_warning = False
+        new_snapshot, _ = Snapshot.find([('plan', '=', plan4.id)])
+        self.assertEqual(new_snapshot.cost_price, Decimal('32.0000'))
+        diff = Snapshot.diff([snapshot.id, new_snapshot.id], config.context)
+        self.assertEqual(diff['products'], [{
+                    'name': 'component 2',
+                    'old': Decimal('9.0000'),
+                    'new': Decimal('12.0000'),
+                    'difference': Decimal('3.0000'),
+                    }])
+        self.assertEqual(
+            [(d['name'], d['difference']) for d in diff['totals']],
+            [('cost_price', Decimal('3.0000')),
+                ('products_cost', Decimal('3.0000'))])
+
+        # Plans are stale when their BOMs change
+        plan4.reload()
+        self.assertFalse(plan4.stale)
+        self.assertNotIn(plan4, CostPlan.find([('stale', '=', True)]))
+        component_bom.reload()
+        bom_input, _ = component_bom.inputs
+        bom_input.quantity = 2
+        component_bom.save()
+        plan4.reload()
+        self.assertTrue(plan4.stale)
+        self.assertIn(plan4, CostPlan.find([('stale', '=', True)]))
+        config.skip_warning = True
+        plan4.click('compute')
+        config.skip_warning = False
+        plan4.reload()
+        self.assertFalse(plan4.stale)
+
+        # Rolled-up plans are stale when the cost of a component changes
+        componentA.cost_price = Decimal(4)
+        componentA.save()
+        plan4.reload()
+        self.assertTrue(plan4.stale)
+        config.skip_warning = True
+        plan4.click('compute')
+        config.skip_warning = False
+        plan4.reload()
+        self.assertFalse(plan4.stale)
+
+        # The sub-assembly cost depends on the outputs of its BOM
+        c1, = [l for l in plan4.products if l.product == component1]
+        c1_cost_price = c1.cost_price
+        bom_output, = component_bom.outputs
+        for quantity in [2, 1]:
+            bom_output.quantity = quantity
+            bom_output.save()
+            config.skip_warning = True
+            plan4.click('compute')
+            config.skip_warning = False
+            plan4.reload()
+            c1, = [l for l in plan4.products if l.product == component1]
+            self.assertEqual(c1.cost_price, c1_cost_price / quantity)
+
+        # The plans using a product are found through the product lines
+        WhereUsed = Model.get('product.cost.plan.where_used')
+        where_used = WhereUsed.find([('product', '=', component2.id)])
+        used, = [w for w in where_used if w.plan == plan4]
+        self.assertEqual(used.lines, 1)
+        self.assertEqual(used.plan_cost_price, plan4.cost_price)
+
+        # Create the BoMs of several plans at once
+        plan2_bom = plan2.bom
+        config.skip_warning = True
+        create_bom = Wizard('product.cost.plan.create_bom', [plan2, plan4])
+        self.assertEqual(create_bom.form.name, None)
+        create_bom.execute('bom')
+        config.skip_warning = False
+        plan2.reload()
+        plan4.reload()
+        self.assertNotEqual(plan2.bom, plan2_bom)
+        self.assertEqual(plan2.bom.name, plan2.rec_name)
+        self.assertEqual(plan4.bom.name, plan4.rec_name)
+        self.assertEqual(
+            sorted([(i.quantity, i.product.rec_name, i.unit.symbol)
+                    for i in plan2.bom.inputs]), [(5.0, 'component 1', 'm'),
+                                                  (150.0, 'component 2', 'cm')])
+        self.assertEqual(len(plan4.bom.inputs), 2)
+        self.assertEqual(plan4.bom.outputs[0].product, plan4.product)
+
+        # Compute a plan with the statistics of the operations
+        config.skip_warning = True
+        with config.set_context(cost_plan_instrumentation=True):
+            CostPlan(plan4.id).click('compute')
+        config.skip_warning = False
+        plan4.reload()
+        self.assertIn('Plan.compute: 1 calls', plan4.compute_statistics)
+        copy_id, = CostPlan.copy([plan4.id], config.context)
+        plan_copy = CostPlan(copy_id)
+        self.assertEqual(plan_copy.compute_statistics, None)
+        self.assertEqual(plan_copy.compute_state, None)
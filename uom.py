@@ -0,0 +1,79 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from weakref import WeakKeyDictionary
+
+from trytond.cache import LRUDict
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['Uom', 'compute_factor', 'compute_qty', 'compute_price']
+
+_caches = WeakKeyDictionary()
+# Maximum number of converted values kept per transaction
+VALUES_CACHE_SIZE = 10000
+
+
+def _get_cache():
+    transaction = Transaction()
+    cache = _caches.get(transaction)
+    if cache is None:
+        cache = _caches[transaction] = {
+            'factors': {},
+            'values': LRUDict(VALUES_CACHE_SIZE),
+            }
+    return cache
+
+
+def compute_factor(from_uom, to_uom):
+    "Returns the quantity of to_uom in one from_uom"
+    pool = Pool()
+    Uom = pool.get('product.uom')
+
+    factors = _get_cache()['factors']
+    key = (from_uom.id, to_uom.id)
+    if key not in factors:
+        if from_uom.category.id == to_uom.category.id:
+            with Transaction().set_context(active_test=False):
+                uoms = Uom.search([
+                        ('category', '=', from_uom.category.id),
+                        ])
+            for uom1 in uoms:
+                for uom2 in uoms:
+                    factors[(uom1.id, uom2.id)] = Uom.compute_qty(
+                        uom1, 1, uom2)
+        if key not in factors:
+            factors[key] = Uom.compute_qty(from_uom, 1, to_uom)
+    return factors[key]
+
+
+def compute_qty(from_uom, qty, to_uom, round=True):
+    "Same as product.uom compute_qty but cached for the transaction"
+    Uom = Pool().get('product.uom')
+    if not qty or from_uom is None or to_uom is None:
+        return Uom.compute_qty(from_uom, qty, to_uom, round=round)
+    values = _get_cache()['values']
+    key = ('qty', from_uom.id, to_uom.id, qty, round)
+    if key not in values:
+        values[key] = Uom.compute_qty(from_uom, qty, to_uom, round=round)
+    return values[key]
+
+
+def compute_price(from_uom, price, to_uom):
+    "Same as product.uom compute_price but cached for the transaction"
+    Uom = Pool().get('product.uom')
+    if not price or from_uom is None or to_uom is None:
+        return Uom.compute_price(from_uom, price, to_uom)
+    values = _get_cache()['values']
+    key = ('price', from_uom.id, to_uom.id, price)
+    if key not in values:
+        values[key] = Uom.compute_price(from_uom, price, to_uom)
+    return values[key]
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+
+    @classmethod
+    def on_modification(cls, mode, uoms, field_names=None):
+        super().on_modification(mode, uoms, field_names=field_names)
+        _caches.pop(Transaction(), None)